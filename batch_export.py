@@ -0,0 +1,156 @@
+# Headless batch export of the KII/Survey and FGD projects in Kobo to Excel
+# workbooks (one per project, with one sheet per verification for FGD
+# projects), or to CSV or Parquet files written in chunks. Projects are
+# selected with the same name filters as the app.
+#
+# Run from the repository root, e.g.
+#     python batch_export.py --output exports/
+#     python batch_export.py --type fgd --zip exports.zip --workers 8
+#     python batch_export.py --format parquet --output exports/
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import kobo_access as ka
+import kobo_export
+
+
+# Projects to export as (uid, name, kind) tuples, kind being 'kii' or 'fgd'
+def select_projects(data_type='all', match=None):
+    user_ids, project_names = ka.extract_kobo_projects()
+    projects = []
+    for user_id, name in zip(user_ids, project_names):
+        if match and match.lower() not in name.lower():
+            continue
+        if data_type in ('kii', 'all') and ka.is_kii_project(name):
+            projects.append((user_id, name, 'kii'))
+        elif data_type in ('fgd', 'all') and ka.is_fgd_project(name):
+            projects.append((user_id, name, 'fgd'))
+    return projects
+
+
+# Write the export of one project to `path`, laid out like the app's
+# downloads for workbooks (see kobo_export.write_project_export). Returns
+# the number of submissions exported, 0 if the project has no data.
+# `reload` downloads every submission again instead of syncing the changes.
+def export_project(user_id, name, kind, path, file_format='xlsx',
+                   constant_memory=False, reload=False):
+    if reload:
+        ka.reload_project(user_id)
+    return kobo_export.write_project_export(
+        user_id, kind, path, file_format, name=name,
+        constant_memory=constant_memory)
+
+
+# File name of a project's export, unique within one export
+def workbook_file_name(name, user_id, taken, file_format='xlsx'):
+    file_name = re.sub(r'[\\/:*?"<>|]+', '_', name).strip() or user_id
+    extension = kobo_export.EXPORT_FORMATS[file_format][0]
+    file_name = f"{file_name} data.{extension}"
+    if file_name in taken:
+        file_name = file_name.replace(f" data.{extension}",
+                                      f" {user_id} data.{extension}")
+    taken.add(file_name)
+    return file_name
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export KII/Survey and FGD projects to Excel workbooks, '
+                    'CSV or Parquet files')
+    parser.add_argument('--type', choices=('kii', 'fgd', 'all'),
+                        default='all', help='projects to export')
+    parser.add_argument('--match', help='only export projects whose name '
+                                        'contains this text')
+    parser.add_argument('--format', default='xlsx',
+                        choices=tuple(kobo_export.EXPORT_FORMATS),
+                        help='file format (CSV and Parquet files hold the '
+                             'FGD answers as a long table)')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--output', help='directory to write files to')
+    target.add_argument('--zip', help='ZIP file to write files to')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='projects exported at the same time')
+    parser.add_argument('--constant-memory', action='store_true',
+                        help="use xlsxwriter's constant memory mode for KII "
+                             "workbooks (FGD workbooks always use it)")
+    parser.add_argument('--reload', action='store_true',
+                        help='download every submission again instead of '
+                             'syncing the new, edited and deleted ones')
+    args = parser.parse_args(argv)
+
+    projects = select_projects(args.type, args.match)
+    print(f"Exporting {len(projects)} project(s) with {args.workers} "
+          f"worker(s)", flush=True)
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+        archive = None
+    else:
+        archive = zipfile.ZipFile(args.zip, 'w', zipfile.ZIP_DEFLATED)
+
+    started = time.perf_counter()
+    exported = 0
+    total_submissions = 0
+    total_bytes = 0
+    failures = 0
+    taken = set()
+
+    # Workers write each project to its own file in a staging directory;
+    # finished files are then moved or zipped from this thread only
+    with tempfile.TemporaryDirectory(dir=args.output) as staging, \
+            ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for number, (user_id, name, kind) in enumerate(projects):
+            path = os.path.join(staging, f"{number}.part")
+            future = executor.submit(export_project, user_id, name, kind,
+                                     path, args.format, args.constant_memory,
+                                     args.reload)
+            futures[future] = (user_id, name, path)
+        for done, future in enumerate(as_completed(futures), start=1):
+            user_id, name, path = futures[future]
+            prefix = f"[{done}/{len(projects)}] {name}"
+            try:
+                submissions = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"{prefix}: failed ({e})", flush=True)
+                continue
+            if not submissions:
+                print(f"{prefix}: no data", flush=True)
+                continue
+
+            file_name = workbook_file_name(name, user_id, taken, args.format)
+            size = os.path.getsize(path)
+            if archive is not None:
+                archive.write(path, file_name)
+                os.remove(path)
+            else:
+                os.replace(path, os.path.join(args.output, file_name))
+
+            exported += 1
+            total_submissions += submissions
+            total_bytes += size
+            elapsed = time.perf_counter() - started
+            print(f"{prefix}: {submissions} submissions, "
+                  f"{size / 1e6:.2f} MB ({elapsed:.1f}s elapsed)",
+                  flush=True)
+
+    if archive is not None:
+        archive.close()
+
+    elapsed = time.perf_counter() - started
+    rate = total_submissions / elapsed if elapsed else 0
+    print(f"Exported {exported} project(s), "
+          f"{total_submissions} submissions, {total_bytes / 1e6:.2f} MB in "
+          f"{elapsed:.1f}s ({rate:.0f} submissions/s)", flush=True)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+# Memory of a labeled KII-like frame before and after compact_frame, and a
+# check that the compacted frame exports the same workbook.
+#
+# Run from the repository root:
+#     python benchmarks/bench_compact.py --rows 20000
+import argparse
+import os
+import sys
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import kobo_access as ka  # noqa: E402
+
+CHOICES = ['Yes', 'No', "Don't know"]
+
+
+# Labeled KII-like frame: one row per submission, one column per question
+def make_frame(rows, questions, seed=0):
+    rng = np.random.default_rng(seed)
+    seconds = rng.integers(0, 3600, size=rows)
+    df = pd.DataFrame({
+        'start': [f"2024-01-01T08:{s // 60:02d}:{s % 60:02d}.000+03:00"
+                  for s in seconds],
+        'end': [f"2024-01-01T09:{s // 60:02d}:{s % 60:02d}.000+03:00"
+                for s in seconds],
+        'Latitude': np.round(rng.uniform(-4, 4, size=rows), 4),
+        'Longitude': np.round(rng.uniform(34, 41, size=rows), 4),
+    })
+    choice_labels = {}
+    for question in range(questions):
+        label = f"Question {question}?"
+        if question % 3 == 2:
+            df[label] = [f"Free text answer {i}" for i in
+                         rng.integers(0, rows, size=rows)]
+        else:
+            answers = np.array(CHOICES + [None], dtype=object)
+            df[label] = answers[rng.integers(0, len(answers), size=rows)]
+            choice_labels[label] = CHOICES
+    return df, choice_labels
+
+
+# Worksheets of an exported workbook (the document properties hold the
+# creation time)
+def sheets(output):
+    archive = zipfile.ZipFile(output)
+    return {name: archive.read(name) for name in archive.namelist()
+            if name != 'docProps/core.xml'}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Memory saved by compact_frame on a KII-like frame')
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--questions', type=int, default=30)
+    args = parser.parse_args()
+
+    df, choice_labels = make_frame(args.rows, args.questions)
+    start = time.perf_counter()
+    compacted = ka.compact_frame(df, choice_labels)
+    elapsed = time.perf_counter() - start
+
+    before = ka.frame_memory(df)
+    after = ka.frame_memory(compacted)
+    print(f"Frame: {args.rows} rows x {len(df.columns)} columns")
+    print(f"Memory: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB "
+          f"({1 - after / before:.0%} less) in {elapsed:.2f}s")
+    print('dtypes:', {dtype: int(count) for dtype, count in
+                      compacted.dtypes.astype(str).value_counts().items()})
+
+    if (sheets(ka.create_excel_file(compacted)) !=
+            sheets(ka.create_excel_file(df))):
+        print('FAIL: the compacted frame exports differently')
+        return 1
+    print('OK: identical export')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+# Benchmark of create_excel_file against the previous per-cell export.
+#
+# Run from the repository root:
+#     python benchmarks/bench_excel.py --rows 60 --cols 3000
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import kobo_access as ka  # noqa: E402
+
+
+# Previous implementation: to_excel followed by a per-cell rewrite
+def legacy_create_excel_file(df, sheet_name='Sheet1'):
+    sheet_name = sheet_name[:31]
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False, sheet_name=sheet_name)
+        workbook = writer.book
+        worksheet = writer.sheets[sheet_name]
+        wrap_border_format = workbook.add_format({
+            'text_wrap': True,
+            'border': 1
+        })
+        if len(df.columns) >= 4:
+            fixed_width = 20
+        else:
+            fixed_width = 40
+        for col_num, _ in enumerate(df.columns):
+            worksheet.set_column(col_num, col_num, fixed_width)
+        for row in range(len(df)):
+            for col in range(len(df.columns)):
+                cell_value = df.iloc[row, col]
+                if pd.isna(cell_value) or (isinstance(cell_value, (int, float)) and np.isinf(cell_value)):
+                    worksheet.write(row + 1, col, '', wrap_border_format)
+                else:
+                    worksheet.write(row + 1, col, cell_value, wrap_border_format)
+    output.seek(0)
+    return output
+
+
+# Transposed KII-like frame: questions in rows, respondents in columns
+def make_frame(rows, cols, seed=0):
+    rng = np.random.default_rng(seed)
+    answers = np.array(['Yes', 'No', 'Apple;Banana;', 'Some free text answer',
+                        None, '12'], dtype=object)
+    data = answers[rng.integers(0, len(answers), size=(rows, cols))]
+    df = pd.DataFrame(data)
+    df.insert(0, 'index', [f'Question {i}?' for i in range(rows)])
+    df.iloc[rng.integers(0, rows, size=cols // 10),
+            rng.integers(1, cols, size=cols // 10)] = np.inf
+    df.columns = [''] * len(df.columns)
+    return df
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    output = func(*args, **kwargs)
+    return time.perf_counter() - start, len(output.getvalue())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark create_excel_file against the per-cell export')
+    parser.add_argument('--rows', type=int, default=60)
+    parser.add_argument('--cols', type=int, default=3000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_frame(args.rows, args.cols)
+    print(f"Frame: {args.rows} rows x {args.cols + 1} columns")
+
+    runs = {
+        'legacy': lambda: legacy_create_excel_file(df, 'Sheet1'),
+        'create_excel_file': lambda: ka.create_excel_file(df, 'Sheet1'),
+        'create_excel_file (constant_memory)':
+            lambda: ka.create_excel_file(df, 'Sheet1', constant_memory=True),
+    }
+    best = {}
+    for name, run in runs.items():
+        times = [timed(run) for _ in range(args.repeat)]
+        best[name] = min(seconds for seconds, _ in times)
+        print(f"{name:38s} {best[name]:8.3f}s  {times[0][1] / 1e6:6.2f} MB")
+
+    for name in list(runs)[1:]:
+        print(f"Speed-up of {name}: {best['legacy'] / best[name]:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
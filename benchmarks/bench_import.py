@@ -0,0 +1,76 @@
+# Import-time budget check for kobo_access.
+#
+# Importing kobo_access must not read secrets, create a Kobo client or load
+# streamlit, xlsxwriter or the HTTP client stack, and should cost little
+# more than importing pandas itself. Exits with status 1 when over budget.
+#
+# Run from the repository root:
+#     python benchmarks/bench_import.py --budget-ms 150
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must only be imported when they are actually used
+DEFERRED_MODULES = ('streamlit', 'xlsxwriter', 'requests', 'koboextractor',
+                    'tenacity', 'kobo_client')
+
+
+# Cumulative import time (ms) of `module` in a fresh interpreter, run from
+# an empty directory without Kobo settings so no secrets file is found
+def import_time_ms(module):
+    env = {key: value for key, value in os.environ.items()
+           if not key.startswith('KOBO_')}
+    env['PYTHONPATH'] = ROOT
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+            cwd=cwd, env=env, capture_output=True, text=True, check=True)
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000
+    raise RuntimeError(f"no import time reported for {module}")
+
+
+def loaded_deferred_modules():
+    code = ('import sys, kobo_access; print(",".join(m for m in %r '
+            'if m in sys.modules))' % (DEFERRED_MODULES,))
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run([sys.executable, '-c', code], cwd=cwd,
+                                env={**os.environ, 'PYTHONPATH': ROOT},
+                                capture_output=True, text=True, check=True)
+    return [m for m in result.stdout.strip().split(',') if m]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the import-time budget of kobo_access')
+    parser.add_argument('--budget-ms', type=float, default=150,
+                        help='allowed import time on top of pandas')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    pandas_ms = min(import_time_ms('pandas') for _ in range(args.repeat))
+    module_ms = min(import_time_ms('kobo_access') for _ in range(args.repeat))
+    overhead = module_ms - pandas_ms
+    print(f"pandas      {pandas_ms:8.1f} ms")
+    print(f"kobo_access {module_ms:8.1f} ms ({overhead:+.1f} ms over pandas,"
+          f" budget {args.budget_ms:.0f} ms)")
+
+    loaded = loaded_deferred_modules()
+    if loaded:
+        print(f"FAIL: imported eagerly: {', '.join(loaded)}")
+        return 1
+    if overhead > args.budget_ms:
+        print("FAIL: over budget")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,48 @@
+# Benchmark of the columnar KII labeling (label_kii_columns) against the
+# per-submission label_result path (label_kii_page), on a synthetic form.
+#
+# Run from the repository root:
+#     python benchmarks/bench_labeling.py --submissions 10000 --questions 60
+import argparse
+import os
+import sys
+import time
+
+from koboextractor import KoboExtractor
+from pandas.testing import assert_frame_equal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import kobo_access as ka  # noqa: E402
+from kobo_fixtures import make_kii_asset, make_kii_submissions  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark columnar against per-submission KII labeling')
+    parser.add_argument('--submissions', type=int, default=10000)
+    parser.add_argument('--questions', type=int, default=60)
+    args = parser.parse_args()
+
+    kobo = KoboExtractor('token', 'https://kobo.invalid/api/v2')
+    schema = ka.AssetSchema(make_kii_asset(questions=args.questions),
+                            kobo=kobo)
+    results = make_kii_submissions(args.submissions, args.questions)
+    print(f"{args.submissions} submissions x {args.questions} questions")
+
+    start = time.perf_counter()
+    rows = ka.label_kii_page(results, schema.choice_lists, schema.questions,
+                             kobo=kobo)
+    row_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    columns = ka.label_kii_columns(results, schema, kobo=kobo)
+    column_seconds = time.perf_counter() - start
+
+    assert_frame_equal(rows, columns, check_exact=True)
+    print(f"label_kii_page    {row_seconds:8.3f}s")
+    print(f"label_kii_columns {column_seconds:8.3f}s")
+    print(f"Speed-up: {row_seconds / column_seconds:.1f}x, identical output")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# Timed and memory-tracked runs of the data pipeline on synthetic projects
+# served by a stub KoboExtractor (see kobo_fixtures.py), written to JSON so
+# runs can be compared.
+#
+# Run from the repository root:
+#     python benchmarks/bench_pipeline.py --sizes 1000,10000 --output run.json
+#     python benchmarks/bench_pipeline.py --baseline run.json
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import kobo_access as ka  # noqa: E402
+import kobo_store  # noqa: E402
+from kobo_fixtures import (StubKobo, make_fgd_asset,  # noqa: E402
+                           make_fgd_submissions, make_kii_asset,
+                           make_kii_submissions)
+
+STAGES = ('extract_kobo_projects', 'get_kii_data', 'generate_dataframes',
+          'create_excel_file')
+
+
+# Best wall time of `repeat` runs of `func`, then (optionally) one more run
+# under tracemalloc for its peak of Python-tracked memory
+def measure(func, track_memory, repeat=1):
+    seconds = None
+    for _ in range(repeat):
+        result = None
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    peak = None
+    if track_memory:
+        del result
+        gc.collect()
+        tracemalloc.start()
+        result = func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+# Stages of one project size. Each run starts from an empty submission
+# store and cleared caches, i.e. a first load of the project.
+def run_size(size, args, track_memory):
+    kii_questions, fgd_questions = args.kii_questions, args.fgd_questions
+    assets = [make_kii_asset(questions=kii_questions),
+              make_fgd_asset(questions=fgd_questions)]
+    assets += [make_kii_asset(uid=f'other{i}', name=f'Other survey {i}')
+               for i in range(args.assets - len(assets))]
+    stages = set(args.stages)
+    submissions = {}
+    if stages & {'get_kii_data', 'create_excel_file'}:
+        submissions['kii'] = make_kii_submissions(size, kii_questions)
+    if 'generate_dataframes' in stages:
+        submissions['fgd'] = make_fgd_submissions(size, fgd_questions)
+    kobo = StubKobo(assets, submissions, latency=args.latency)
+    ka.set_kobo_extractor(kobo)
+
+    def cold(func):
+        def run():
+            ka.clear_cache()
+            kobo_store.STORE_DIR = tempfile.mkdtemp(dir=args.store_dir)
+            return func()
+        return run
+
+    runs = {
+        'extract_kobo_projects': cold(ka.extract_kobo_projects),
+        'get_kii_data': cold(lambda: ka.get_kii_data('kii', kobo=kobo)),
+        'generate_dataframes':
+            cold(lambda: ka.generate_dataframes('fgd', kobo=kobo)),
+    }
+    results = []
+    kii_table = None
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        if stage == 'create_excel_file':
+            if kii_table is None:
+                kii = cold(lambda: ka.get_kii_data('kii', kobo=kobo))()
+                kii_table = ka.without_column_names(kii.T.reset_index())
+
+            def run():
+                return ka.create_excel_file(kii_table, sheet_name='KII')
+        else:
+            run = runs[stage]
+
+        requests = kobo.requests
+        output, seconds, peak = measure(run, track_memory, args.repeat)
+        runs_made = args.repeat + (1 if track_memory else 0)
+        record = {'stage': stage, 'submissions': size,
+                  'seconds': round(seconds, 4),
+                  'peak_memory_mb': (round(peak / 1e6, 2)
+                                     if peak is not None else None),
+                  'requests': (kobo.requests - requests) // runs_made}
+        if isinstance(output, pd.DataFrame):
+            record['shape'] = list(output.shape)
+        elif isinstance(output, dict):
+            record['frames'] = len(output)
+        elif hasattr(output, 'getbuffer'):
+            record['bytes'] = output.getbuffer().nbytes
+        if stage == 'get_kii_data' and output is not None:
+            kii_table = ka.without_column_names(output.T.reset_index())
+        del output
+        results.append(record)
+
+        memory = (f", peak {record['peak_memory_mb']:.1f} MB"
+                  if peak is not None else '')
+        print(f"{stage:22s} {size:>8d} submissions {seconds:9.3f}s{memory}",
+              flush=True)
+    return results
+
+
+# Compare with a previous run: ratio of wall times per stage and size
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {(r['stage'], r['submissions']): r
+                    for r in json.load(f)['results']}
+    regressions = 0
+    print(f"\nCompared with {baseline_path}:")
+    for record in results:
+        previous = baseline.get((record['stage'], record['submissions']))
+        if not previous or not previous['seconds']:
+            continue
+        ratio = record['seconds'] / previous['seconds']
+        flag = ''
+        if ratio > tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{record['stage']:22s} {record['submissions']:>8d} "
+              f"{previous['seconds']:9.3f}s -> {record['seconds']:9.3f}s "
+              f"({ratio:.2f}x){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pipeline on synthetic Kobo projects')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma-separated numbers of submissions')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help=f"comma-separated subset of {', '.join(STAGES)}")
+    parser.add_argument('--kii-questions', type=int, default=60)
+    parser.add_argument('--fgd-questions', type=int, default=10)
+    parser.add_argument('--assets', type=int, default=200,
+                        help='assets in the project list')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every stub request')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='timed runs per stage, the best one is kept')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc runs')
+    parser.add_argument('--output', default='bench_pipeline.json',
+                        help='JSON file to write the results to')
+    parser.add_argument('--baseline', help='previous results to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='slow-down ratio reported as a regression')
+    args = parser.parse_args()
+    args.stages = [stage.strip() for stage in args.stages.split(',')]
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        args.store_dir = store_dir
+        results = []
+        for size in sizes:
+            results += run_size(size, args, not args.no_memory)
+
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'settings': {'kii_questions': args.kii_questions,
+                     'fgd_questions': args.fgd_questions,
+                     'assets': args.assets, 'latency': args.latency,
+                     'repeat': args.repeat,
+                     'page_size': ka.PAGE_SIZE,
+                     'incremental_sync': ka.INCREMENTAL_SYNC},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        return 1 if compare(results, args.baseline, args.tolerance) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
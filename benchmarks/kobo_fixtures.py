@@ -0,0 +1,206 @@
+# Synthetic Kobo assets and submissions, and a stub KoboExtractor serving
+# them from memory, for running the pipeline without Kobo access.
+import copy
+import json
+import random
+import time
+
+from koboextractor import KoboExtractor
+
+YES_NO = [('1', 'Yes'), ('0', 'No')]
+FRUITS = [('a', 'Apple'), ('b', 'Banana'), ('c', 'Cherry')]
+GENDERS = [('m', 'Male'), ('f', 'Female')]
+
+
+def _choices(list_name, options):
+    return [{'list_name': list_name, 'name': name, 'label': [label]}
+            for name, label in options]
+
+
+# KII/Survey asset: `questions` select_one, select_multiple and text
+# questions in one group, plus a "Time difference in" question the app drops
+def make_kii_asset(uid='kii', name='Synthetic KII', questions=60):
+    survey = [{'type': 'start', 'name': 'start'},
+              {'type': 'end', 'name': 'end'},
+              {'type': 'begin_group', 'name': 'grp', 'label': ['Group']}]
+    for i in range(questions):
+        question = {'name': f'q{i}', 'label': [f'Question {i}']}
+        if i % 3 == 0:
+            question.update(type='select_one', select_from_list_name='yn')
+        elif i % 3 == 1:
+            question.update(type='select_multiple',
+                            select_from_list_name='fruit')
+        else:
+            question.update(type='text')
+        survey.append(question)
+    survey.append({'type': 'integer', 'name': 'td',
+                   'label': ['Time difference in minutes']})
+    survey.append({'type': 'end_group'})
+    return {'uid': uid, 'name': name, 'deployed_version_id': 'v1',
+            'content': {'survey': survey,
+                        'choices': (_choices('yn', YES_NO) +
+                                    _choices('fruit', FRUITS))}}
+
+
+def make_kii_submissions(count, questions=60, seed=0):
+    rng = random.Random(seed)
+    submissions = []
+    for i in range(count):
+        second = i % 3600
+        submission = {
+            '_id': i + 1,
+            'start': f'2024-01-01T08:{second // 60:02d}:{second % 60:02d}'
+                     '.000+03:00',
+            'end': '2024-01-01T09:00:00.000+03:00',
+            '_submission_time': f'2024-01-{1 + i % 28:02d}T10:00:00',
+            '_geolocation': [round(-1 + i / 1e5, 6), round(36 + i / 1e5, 6)],
+            'grp/td': '5',
+        }
+        for q in range(questions):
+            if rng.random() < 0.1:
+                continue
+            if q % 3 == 0:
+                submission[f'grp/q{q}'] = rng.choice(['1', '0'])
+            elif q % 3 == 1:
+                submission[f'grp/q{q}'] = rng.choice(['a', 'b', 'a c'])
+            else:
+                submission[f'grp/q{q}'] = f'Answer {rng.randint(0, 999)}'
+        submissions.append(submission)
+    return submissions
+
+
+# FGD asset: verification number and precise location in section_b, and a
+# repeat group of `questions` questions (one entry per respondent) in
+# section_c, all inside consented_grp
+def make_fgd_asset(uid='fgd', name='Synthetic FGD', questions=10,
+                   verifications=20):
+    survey = [{'type': 'start', 'name': 'start'},
+              {'type': 'end', 'name': 'end'},
+              {'type': 'begin_group', 'name': 'consented_grp',
+               'label': ['Consented']},
+              {'type': 'begin_group', 'name': 'section_b',
+               'label': ['Section B']},
+              {'type': 'select_one', 'name': 'verification_no',
+               'label': ['Verification number'],
+               'select_from_list_name': 'verification_no'},
+              {'type': 'geopoint', 'name': 'precise_location',
+               'label': ['Location of ${site}']},
+              {'type': 'end_group'},
+              {'type': 'begin_group', 'name': 'section_c',
+               'label': ['Section C']},
+              {'type': 'begin_repeat', 'name': 'respondents',
+               'label': ['Respondents']},
+              {'type': 'select_one', 'name': 'gender',
+               'label': ['Gender of ${name}\nAsk politely'],
+               'select_from_list_name': 'gender'}]
+    for i in range(questions - 1):
+        question = {'name': f'q{i}', 'label': [f'Question {i}']}
+        if i % 2 == 0:
+            question.update(type='select_one', select_from_list_name='yn')
+        else:
+            question.update(type='text')
+        survey.append(question)
+    survey += [{'type': 'end_repeat'}, {'type': 'end_group'},
+               {'type': 'end_group'}]
+    choices = (_choices('verification_no',
+                        [(str(i), f'Verification {i}')
+                         for i in range(1, verifications + 1)]) +
+               _choices('gender', GENDERS) + _choices('yn', YES_NO))
+    return {'uid': uid, 'name': name, 'deployed_version_id': 'v1',
+            'content': {'survey': survey, 'choices': choices}}
+
+
+def make_fgd_submissions(count, questions=10, verifications=20,
+                         respondents=(3, 8), seed=0):
+    rng = random.Random(seed)
+    repeat = 'consented_grp/section_c/respondents'
+    submissions = []
+    for i in range(count):
+        entries = []
+        for _ in range(rng.randint(*respondents)):
+            entry = {f'{repeat}/gender': rng.choice('mf')}
+            for q in range(questions - 1):
+                entry[f'{repeat}/q{q}'] = (rng.choice('10') if q % 2 == 0
+                                           else f'Answer {rng.randint(0, 99)}')
+            entries.append(entry)
+        submissions.append({
+            '_id': i + 1,
+            'start': '2024-01-01T08:00:00.000+03:00',
+            'end': '2024-01-01T09:00:00.000+03:00',
+            '_submission_time': f'2024-02-{1 + i % 28:02d}T10:00:00',
+            'consented_grp/section_b/verification_no':
+                str(1 + i % verifications),
+            'consented_grp/section_b/precise_location':
+                f'{-1 - i / 1e5:.6f} {36 + i / 1e5:.6f} 1700 5',
+            repeat: entries,
+        })
+    return submissions
+
+
+# KoboExtractor serving assets and submissions from memory. Responses are
+# JSON-decoded like the real API's, so the callers pay the same decoding
+# and copying costs; `latency` adds a fixed delay per request.
+class StubKobo(KoboExtractor):
+    def __init__(self, assets, submissions, latency=0):
+        super().__init__('stub-token', 'https://kobo.invalid/api/v2')
+        self.assets = {asset['uid']: asset for asset in assets}
+        self.submissions = submissions
+        self.latency = latency
+        self.requests = 0
+
+    def _respond(self, content):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return json.loads(json.dumps(content))
+
+    def list_assets(self):
+        return self._respond({'results': [
+            {'uid': uid, 'name': asset['name'],
+             'deployment__submission_count': len(self.submissions.get(uid,
+                                                                      [])),
+             'deployment__last_submission_time': None,
+             'date_modified': '2024-01-01T00:00:00Z',
+             'deployed_version_id': asset.get('deployed_version_id')}
+            for uid, asset in self.assets.items()]})
+
+    def get_asset(self, asset_uid):
+        return self._respond(copy.deepcopy(self.assets[asset_uid]))
+
+    # Supports the queries the app sends: equality, $gt/$gte/$lt
+    # comparisons and $in lists per field (e.g. {"_id": {"$gt": id}}), plus
+    # the `fields` projection and `sort` order of KoboClient.get_data
+    def get_data(self, asset_uid, query=None, start=None, limit=None,
+                 submitted_after=None, fields=None, sort=None):
+        results = self.submissions.get(asset_uid, [])
+        if query:
+            results = [r for r in results
+                       if all(_matches(r.get(field), condition)
+                              for field, condition
+                              in json.loads(query).items())]
+        if sort:
+            for field, direction in reversed(json.loads(sort).items()):
+                results = sorted(results, key=lambda r: r.get(field),
+                                 reverse=direction < 0)
+        count = len(results)
+        start = start or 0
+        page = results[start:start + limit] if limit else results[start:]
+        if fields:
+            wanted = json.loads(fields)
+            page = [{field: r[field] for field in wanted if field in r}
+                    for r in page]
+        next_url = ('https://kobo.invalid/next'
+                    if start + len(page) < count else None)
+        return self._respond({'count': count, 'next': next_url,
+                              'previous': None, 'results': page})
+
+
+OPERATORS = {'$gt': lambda a, b: a > b, '$gte': lambda a, b: a >= b,
+             '$lt': lambda a, b: a < b, '$in': lambda a, b: a in b}
+
+
+def _matches(value, condition):
+    if not isinstance(condition, dict):
+        return value == condition
+    return value is not None and all(OPERATORS[op](value, operand)
+                                     for op, operand in condition.items())
@@ -4,11 +4,18 @@ import streamlit_authenticator as stauth
 import yaml
 from yaml.loader import SafeLoader
 import kobo_access as ka
+import kobo_export
+import kobo_map
+import kobo_prefetch
+import kobo_trace
 
 # # Page configuration
 st.set_page_config(page_title="Data Handling", page_icon=":bar_chart:",
                    layout="wide")
 
+# Collect the timings of this run for the diagnostics panel
+trace = kobo_trace.start_trace()
+
 # CSS to style the header section
 st.markdown("""
     <style>
@@ -75,6 +82,9 @@ except Exception as e:
 
 if st.session_state['authentication_status']:
     st.sidebar.write(f'Welcome **{st.session_state["name"]}**')
+    # Keep the project list and the hot projects warm in the background
+    if kobo_prefetch.PREFETCH:
+        kobo_prefetch.start_prefetcher()
     # set title
     # st.title("Download, Format and Edit Data")
 
@@ -97,8 +107,8 @@ if st.session_state['authentication_status']:
         # Handling KII data
         if data_type == "KII/Survey":
             # Extract KII data only and allow user to select one
-            kiis = [name for name in project_names if 'kii' in name.lower() or
-                    'survey' in name.lower()]
+            kiis = [name for name in project_names
+                    if ka.is_kii_project(name)]
 
             # Let user choose a KII from the list
             kii_selected = st.sidebar.selectbox(
@@ -112,17 +122,49 @@ if st.session_state['authentication_status']:
 
                 # Get the corresponding user ID
                 user_id_kii_selected = user_ids[index_kii_selected]
-                df = ka.get_kii_data(user_id_kii_selected)
+                ka.record_project_use(user_id_kii_selected, 'kii')
+                # Download the project again, e.g. after answers were
+                # corrected on Kobo
+                if st.sidebar.button("Reload from Kobo",
+                                     key=f"{user_id_kii_selected}_reload"):
+                    ka.reload_project(user_id_kii_selected)
+                    kobo_export.remove_stale_exports(user_id_kii_selected)
+                    st.sidebar.success("Reloaded from Kobo.")
+                # Optional filters, applied by Kobo before downloading
+                kii_filter = ka.kii_filter_controls(
+                    user_id_kii_selected, key=user_id_kii_selected)
+                kii_selection = ka.kii_selection_name(*kii_filter)
+                # Get the data, one respondent per row. It is shown and
+                # exported transposed, with the questions in the first
+                # column. Data saved in the frame store is only read in
+                # parts, as the view needs it.
+                with kobo_trace.span('load_kii',
+                                     asset=user_id_kii_selected) as record:
+                    df = ka.get_kii_frame(user_id_kii_selected, *kii_filter)
+                    if df is not None:
+                        record.set(rows=df.shape[0], cols=df.shape[1])
+                # Memory saved by dtype compaction, when enabled
+                memory_report = ka.get_memory_report(user_id_kii_selected,
+                                                     kii_selection)
+                if memory_report:
+                    st.sidebar.caption(memory_report)
 
                 # Check for availability of data
                 if df is not None:
-                    #transpose the data
-                    df = df.T
-
-                    # Set first column as the index
-                    df.reset_index(inplace=True)
-
-
+                    # Whole selection as a CSV or Parquet file, written in
+                    # chunks on request
+                    kobo_export.export_controls(
+                        user_id_kii_selected, 'kii', f"{kii_selected} data",
+                        key=user_id_kii_selected, query=kii_filter[0],
+                        fields=kii_filter[1])
+                    # Locations of the selection, binned on a map
+                    if st.sidebar.checkbox(
+                            "Show map", key=f"{user_id_kii_selected}_map"):
+                        st.subheader(f"{kii_selected} locations")
+                        kobo_map.location_map(
+                            ka.get_cached_locations(user_id_kii_selected,
+                                                    'kii', *kii_filter),
+                            key=user_id_kii_selected)
                     # Select what to do with the file
                     action_kii = st.sidebar.selectbox("What do you want to"
                                                       " do with the data?",
@@ -131,44 +173,35 @@ if st.session_state['authentication_status']:
                     if action_kii is not None:
                         if action_kii == "View":
                             st.subheader(f"{kii_selected}")
-                            # Remove column names
-                            df.columns = [''] * len(df.columns)
-                            st.markdown(df.to_html(escape=False),
-                                        unsafe_allow_html=True)
-                            # Create downloadable excel
-                            output = ka.create_excel_file(
-                                    df,
-                                    sheet_name=kii_selected)
-
-                            # Download button for the Excel file
-                            st.sidebar.download_button(
-                                label="Download data as Excel",
-                                data=output,
+                            # Show a window of the data
+                            ka.windowed_view(df, key=user_id_kii_selected,
+                                             transposed=True)
+                            # Downloadable excel without column names,
+                            # built on request
+                            ka.excel_download_button(
+                                df, sheet_name=kii_selected,
                                 file_name=f"{kii_selected} data.xlsx",
-                                mime="application/vnd.openxmlformats-officedocument"
-                                     ".spreadsheetml.sheet"
-                            )
+                                key=f"{user_id_kii_selected}_view",
+                                transposed=True)
                         if action_kii == "Review":
                             st.subheader(f"{kii_selected}")
-                            edited_df = ka.editable_dataframe(df)
+                            # Committed edits are kept in a log replayed
+                            # on top of the fetched data
+                            edited_df = ka.editable_dataframe(
+                                ka.get_cached_kii_data(user_id_kii_selected,
+                                                       *kii_filter),
+                                ka.get_edit_log(user_id_kii_selected,
+                                                    kii_selection),
+                                transposed=True)
                             # Check if new_df has been created successfully
                             # before calling to_html
                             if edited_df is not None:
-                                # Create downloadable excel
-                                # Remove column names
-                                edited_df.columns = [''] * len(edited_df.columns)
-                                output = ka.create_excel_file(
-                                    edited_df,
-                                    sheet_name=kii_selected)
-
-                                # Download button for the Excel file
-                                st.sidebar.download_button(
-                                    label="Download data as Excel",
-                                    data=output,
+                                # Downloadable excel without column names,
+                                # built on request
+                                ka.excel_download_button(
+                                    edited_df, sheet_name=kii_selected,
                                     file_name=f"{kii_selected} Reviewed Data.xlsx",
-                                    mime="application/vnd.openxmlformats-officedocument"
-                                         ".spreadsheetml.sheet"
-                                )
+                                    key=f"{user_id_kii_selected}_review")
                             else:
                                 st.warning(
                                     "Please commit changes to get "
@@ -183,7 +216,8 @@ if st.session_state['authentication_status']:
         if data_type == "FGD":
 
             # Extract KII data only and allow user to select one
-            fgds = [name for name in project_names if 'fgd' in name.lower()]
+            fgds = [name for name in project_names
+                    if ka.is_fgd_project(name)]
 
             # Let user choose a KII from the list
             fgd_selected = st.sidebar.selectbox(
@@ -195,11 +229,38 @@ if st.session_state['authentication_status']:
             if fgd_selected is not None:
                 index_fgd_selected = project_names.index(fgd_selected)
                 user_id_selected = user_ids[index_fgd_selected]
-
-                dfs = ka.generate_dataframes(user_id_selected)
-
-                if dfs is not None:
-                    ver_fgd = dfs.keys()
+                ka.record_project_use(user_id_selected, 'fgd')
+                # Download the project again, e.g. after answers were
+                # corrected on Kobo
+                if st.sidebar.button("Reload from Kobo",
+                                     key=f"{user_id_selected}_reload"):
+                    ka.reload_project(user_id_selected)
+                    kobo_export.remove_stale_exports(user_id_selected)
+                    st.sidebar.success("Reloaded from Kobo.")
+
+                # Only index the verifications here, the frame of the
+                # selected one is built on demand
+                with kobo_trace.span('load_fgd_index',
+                                     asset=user_id_selected) as record:
+                    verifications = ka.get_cached_verification_index(
+                        user_id_selected)
+                    record.set(rows=len(verifications))
+
+                if verifications:
+                    ver_fgd = verifications.keys()
+
+                    # All verifications in one workbook, or the answers as
+                    # a CSV or Parquet file, written on request
+                    kobo_export.export_controls(
+                        user_id_selected, 'fgd', f"{fgd_selected} data",
+                        key=user_id_selected)
+                    # Locations of all the verifications, binned on a map
+                    if st.sidebar.checkbox(
+                            "Show map", key=f"{user_id_selected}_map"):
+                        st.subheader(f"{fgd_selected} locations")
+                        kobo_map.location_map(
+                            ka.get_cached_locations(user_id_selected, 'fgd'),
+                            key=user_id_selected)
 
                     # Select what to do with the file
                     fgd_select1 = st.sidebar.selectbox(
@@ -208,54 +269,49 @@ if st.session_state['authentication_status']:
 
                     # Select what to do with the file
                     if fgd_select1 is not None:
+                        ka.record_project_use(user_id_selected, 'fgd',
+                                              fgd_select1)
                         action_fgd = st.sidebar.selectbox("What do you want to"
                                                           " do with the data?",
                                                           ("View", "Review"),
                                                           index=None)
-                        df = dfs[fgd_select1]
+                        with kobo_trace.span('load_fgd',
+                                             asset=user_id_selected) as record:
+                            df = ka.get_cached_verification_frame(
+                                user_id_selected, fgd_select1)
+                            record.set(rows=df.shape[0], cols=df.shape[1])
+                        memory_report = ka.get_memory_report(
+                            user_id_selected, fgd_select1)
+                        if memory_report:
+                            st.sidebar.caption(memory_report)
 
                         # Remove column names
                         if action_fgd is not None:
                             if action_fgd == "View":
                                 st.subheader(f"{fgd_select1}")
-                                df.columns = [''] * len(df.columns)
-                                st.markdown(df.to_html(escape=False),
-                                            unsafe_allow_html=True)
-                                # Create downloadable excel
-                                output = ka.create_excel_file(
-                                    df,
-                                    sheet_name=fgd_select1)
-
-                                # Download button for the Excel file
-                                st.sidebar.download_button(
-                                    label="Download data as Excel",
-                                    data=output,
+                                # Show a window of the data
+                                ka.windowed_view(
+                                    df, key=f"{user_id_selected}_{fgd_select1}")
+                                # Downloadable excel without column names,
+                                # built on request
+                                ka.excel_download_button(
+                                    df, sheet_name=fgd_select1,
                                     file_name=f"{fgd_select1} data.xlsx",
-                                    mime="application/vnd.openxmlformats-officedocument"
-                                         ".spreadsheetml.sheet"
-                                )
+                                    key=f"{user_id_selected}_{fgd_select1}_view")
                             if action_fgd == "Review":
                                 st.subheader(f"{fgd_select1}")
                                 edited_df = ka.editable_dataframe(
-                                    df,
-                                    sheet_name=fgd_select1)
+                                    df, ka.get_edit_log(user_id_selected,
+                                                        fgd_select1))
                                 # Check if new_df has been created successfully
                                 # before calling to_html
                                 if edited_df is not None:
-                                    # Create downloadable excel
-                                    edited_df.columns = [''] * len(edited_df.columns)
-                                    output = ka.create_excel_file(
-                                    edited_df,
-                                    sheet_name=fgd_select1)
-
-                                    # Download button for the Excel file
-                                    st.sidebar.download_button(
-                                        label="Download data as Excel",
-                                        data=output,
+                                    # Downloadable excel without column
+                                    # names, built on request
+                                    ka.excel_download_button(
+                                        edited_df, sheet_name=fgd_select1,
                                         file_name=f"{fgd_select1} Reviewed Data.xlsx",
-                                        mime="application/vnd.openxmlformats-officedocument"
-                                             ".spreadsheetml.sheet"
-                                    )
+                                        key=f"{user_id_selected}_{fgd_select1}_review")
                                 else:
                                     st.warning(
                                         "Please commit changes to get "
@@ -265,6 +321,10 @@ if st.session_state['authentication_status']:
                     st.write(f"No data available for {fgd_selected}")
                     pass
 
+    # Timings, Kobo traffic and cache hits of this run
+    if st.sidebar.checkbox("Show diagnostics", key="diagnostics"):
+        ka.diagnostics_panel(trace)
+
     authenticator.logout("Logout", "sidebar")
 elif st.session_state['authentication_status'] is False:
     st.error('Username/password is incorrect')
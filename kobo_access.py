@@ -1,24 +1,163 @@
-from koboextractor import KoboExtractor
-import streamlit as st
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import re
+import os
+import sys
+import json
+import math
 import base64
+import hashlib
+import itertools
+import threading
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from io import BytesIO
-import numpy as np
-import xlsxwriter
+from kobo_cache import ResultCache
+from kobo_store import (EditLog, FrameStore, StoredFrame, SubmissionStore,
+                        INSTANCE_ID_FIELD)
+from kobo_trace import span, traced
+
+# Streamlit, xlsxwriter and the HTTP client stack are imported where they
+# are used, so importing this module stays cheap and has no side effects
+# (no secrets are read and no client is created until Kobo is first called).
+
+# Store the extraction information. The token is read from the KOBO_TOKEN
+# environment variable, falling back to the Streamlit secrets.
+url = os.environ.get('KOBO_URL', 'https://kf.kobotoolbox.org/api/v2')
+
+# Number of Kobo calls that may run at the same time
+KOBO_MAX_CONCURRENCY = 4
+
+# Cache settings (TTLs in seconds). The asset list is refreshed often since
+# it carries the freshness token for every project; processed frames are
+# kept longer because they are invalidated by that token. They are shared by
+# all sessions of the process within a memory budget (MB). Schemas are kept
+# per form, and memory reports (see compact_cached_frame) per cached frame,
+# up to a number of entries.
+PROJECTS_CACHE_TTL = 300
+DATA_CACHE_TTL = 3600
+DATA_CACHE_MB = int(os.environ.get('KOBO_DATA_CACHE_MB', '1024'))
+SCHEMA_CACHE_TTL = 24 * 3600
+SCHEMA_CACHE_SIZE = 32
+MEMORY_REPORTS_SIZE = 64
+
+# Total size of the workbooks kept for download (MB), least recently used
+# first out
+EXCEL_CACHE_MB = int(os.environ.get('KOBO_EXCEL_CACHE_MB', '256'))
+
+# Number of submissions requested from Kobo per page
+PAGE_SIZE = 1000
+
+# Incremental syncs list the `_id` and instance id of every submission, in
+# larger pages since these rows are tiny, and download the submissions
+# edited on Kobo by batches of ids
+SYNC_LIST_PAGE_SIZE = 10000
+SYNC_ID_BATCH = 500
+
+# Keep a local copy of the submissions of each asset and only download the
+# ones submitted since the last sync
+INCREMENTAL_SYNC = os.environ.get('KOBO_INCREMENTAL_SYNC', '1') == '1'
+
+# Save labeled frames as Arrow files per asset version, so they are read
+# back memory-mapped after a restart or by another replica instead of being
+# labeled again
+FRAME_STORE = os.environ.get('KOBO_FRAME_STORE', '1') == '1'
+
+# Compact the dtypes of cached labeled frames (see compact_frame)
+COMPACT_DTYPES = os.environ.get('KOBO_COMPACT_DTYPES', '0') == '1'
+
+# Optional worker pool for flattening FGD submissions, used by the FGD
+# exports and generate_dataframes (see iter_repeat_group_tables). With 0 or
+# 1 workers the chunks are flattened in this process; otherwise each chunk
+# of FGD_CHUNK_SIZE submissions is flattened by a worker. The executor is
+# 'process' (default) or 'thread'.
+FGD_WORKERS = int(os.environ.get('KOBO_FGD_WORKERS', '0'))
+FGD_EXECUTOR = os.environ.get('KOBO_FGD_EXECUTOR', 'process')
+
+# Number of FGD submissions flattened together by the chunked FGD loaders
+# (see iter_repeat_group_tables) and per worker task
+FGD_CHUNK_SIZE = 1000
+
+# Size of the window shown by windowed_view (question rows x respondent
+# columns)
+VIEW_ROWS = 50
+VIEW_COLUMNS = 20
+
+# Number of recently opened projects remembered for the prefetcher
+RECENT_PROJECTS = 32
+
+# Submission field holding the verification number of an FGD
+VERIFICATION_FIELD = 'consented_grp/section_b/verification_no'
+
+_assets_cache = ResultCache(maxsize=1, ttl=PROJECTS_CACHE_TTL)
+_data_cache = ResultCache(maxsize=DATA_CACHE_MB * 1024 * 1024,
+                          ttl=DATA_CACHE_TTL, name='data',
+                          getsizeof=lambda value: cached_size(value))
+_schema_cache = ResultCache(maxsize=SCHEMA_CACHE_SIZE, ttl=SCHEMA_CACHE_TTL,
+                            name='schema')
+_memory_reports = ResultCache(maxsize=MEMORY_REPORTS_SIZE,
+                              ttl=DATA_CACHE_TTL)
+_excel_files = ResultCache(maxsize=EXCEL_CACHE_MB * 1024 * 1024,
+                           ttl=DATA_CACHE_TTL, name='excel', getsizeof=len)
+
+
+_kobo = None
+_kobo_lock = threading.Lock()
+
+
+# Kobo API token, from the environment or else the Streamlit secrets
+def get_kobo_token():
+    token = os.environ.get('KOBO_TOKEN')
+    if token:
+        return token
+    import streamlit as st
+    return st.secrets["KOBO_TOKEN"]
+
+
+# Create the Kobo client shared by the whole process (one connection pool).
+# A token or endpoint passed here replaces the shared client.
+def initialize_kobo_extractor(token=None, endpoint=None):
+    global _kobo
+    from kobo_client import KoboClient
+    with _kobo_lock:
+        if _kobo is None or token or endpoint:
+            _kobo = KoboClient(token or get_kobo_token(), endpoint or url)
+        return _kobo
+
+
+# Use another extractor (e.g. a stub) as the shared Kobo client
+def set_kobo_extractor(kobo):
+    global _kobo
+    with _kobo_lock:
+        _kobo = kobo
+
+
+# The shared Kobo client, created on first use
+def get_kobo():
+    if _kobo is None:
+        return initialize_kobo_extractor()
+    return _kobo
+
 
-# Store the extraction information
-KOBO_TOKEN = st.secrets["KOBO_TOKEN"]
-url = 'https://kf.kobotoolbox.org/api/v2'
+# Lazy module attributes kept for existing callers of `kobo_access.kobo`
+def __getattr__(name):
+    if name == 'kobo':
+        return get_kobo()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-# Initiate the KoboExtractor
-kobo = KoboExtractor(KOBO_TOKEN, url)
 
+_io_executor = None
 
-def initialize_kobo_extractor():
-    # Initiate the KoboExtractor
-    kobo = KoboExtractor(KOBO_TOKEN, url)
-    return kobo
+
+# Thread pool used to run independent Kobo calls at the same time
+def get_io_executor():
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(max_workers=KOBO_MAX_CONCURRENCY,
+                                          thread_name_prefix='kobo-io')
+    return _io_executor
 
 
 # Function to encode a local image file to base64
@@ -27,6 +166,99 @@ def get_base64_of_bin_file(bin_file):
         data = f.read()
     return base64.b64encode(data).decode()
 
+# Get the asset list, reusing the cached copy while it is fresh
+def list_kobo_assets():
+    return _assets_cache.get_or_compute('assets', _fetch_kobo_assets)
+
+
+def _fetch_kobo_assets():
+    with span('list_assets') as record:
+        assets = get_kobo().list_assets()['results']
+        record.set(rows=len(assets))
+    return assets
+
+
+# Download the asset list again even if the cached one has not expired
+# (e.g. from the background prefetcher), which also moves the freshness
+# token of every project that changed
+def refresh_kobo_assets():
+    assets = _fetch_kobo_assets()
+    _assets_cache.set('assets', assets)
+    return assets
+
+
+# Entry of an asset in the cached asset list (empty if not listed)
+def get_asset_info(user_uid):
+    for asset in list_kobo_assets():
+        if asset['uid'] == user_uid:
+            return asset
+    return {}
+
+
+# Cheap token that changes whenever a project receives new submissions or
+# its form is redeployed; taken from the cached asset list so that checking
+# it costs no network call
+def get_freshness_token(user_uid):
+    asset = get_asset_info(user_uid)
+    if not asset:
+        return None
+    return (asset.get('deployment__submission_count'),
+            asset.get('deployment__last_submission_time'),
+            asset.get('date_modified'))
+
+
+_project_uses = OrderedDict()
+_project_uses_lock = threading.Lock()
+
+
+# Remember that a user opened a project ('kii' or 'fgd') or one FGD
+# verification of it
+def record_project_use(user_uid, kind, ver_no=None):
+    key = (kind, user_uid, ver_no)
+    with _project_uses_lock:
+        _project_uses.pop(key, None)
+        _project_uses[key] = None
+        while len(_project_uses) > RECENT_PROJECTS:
+            _project_uses.popitem(last=False)
+
+
+# Up to `count` (kind, asset uid, verification) targets worth keeping warm:
+# the most recently opened first, then the listed KII/FGD projects with the
+# latest submissions
+def hot_projects(count):
+    assets = list_kobo_assets()
+    listed = {asset['uid'] for asset in assets}
+    with _project_uses_lock:
+        recent = list(reversed(_project_uses))
+    targets = [target for target in recent if target[1] in listed][:count]
+
+    taken = {target[1] for target in targets}
+    active = sorted(
+        (asset for asset in assets
+         if asset.get('deployment__submission_count')),
+        key=lambda asset: asset.get('deployment__last_submission_time') or '',
+        reverse=True)
+    for asset in active:
+        if len(targets) >= count:
+            break
+        if asset['uid'] in taken:
+            continue
+        if is_kii_project(asset['name']):
+            targets.append(('kii', asset['uid'], None))
+        elif is_fgd_project(asset['name']):
+            targets.append(('fgd', asset['uid'], None))
+    return targets
+
+
+# Name filters used to tell KII/Survey and FGD projects apart
+def is_kii_project(name):
+    return 'kii' in name.lower() or 'survey' in name.lower()
+
+
+def is_fgd_project(name):
+    return 'fgd' in name.lower()
+
+
 # Get verifications
 def extract_kobo_projects():
     # Initialize lists to store user IDs and project names
@@ -34,68 +266,388 @@ def extract_kobo_projects():
     project_names = []
 
     # Retrieve assets and extract information
-    assets = kobo.list_assets()
-    for asset in assets['results']:
+    for asset in list_kobo_assets():
         user_ids.append(asset['uid'])
         project_names.append(asset['name'])
 
     return user_ids, project_names
 
 
-def get_kii_data(user_uid, kobo=kobo):
-    # Retrieve asset, choices, and questions from Kobo API
-    asset = kobo.get_asset(user_uid)
-    choice_lists = kobo.get_choices(asset)
-    questions = kobo.get_questions(asset=asset, unpack_multiples=True)
-
-    # Fetch the data
-    new_data = kobo.get_data(user_uid)
-
-    # Check if data is available
-    if new_data['results']:
-        # Sort results by time and label each result
-        new_results = kobo.sort_results_by_time(new_data['results'])
-        labeled_results = [
-            kobo.label_result(
-                unlabeled_result=result,
-                choice_lists=choice_lists,
-                questions=questions,
-                unpack_multiples=True
-            )
-            for result in new_results
-        ]
-
-        # List to store combined rows for each entry
-        combined_rows = []
-
-        # Process each labeled result
-        for entry in labeled_results:
-            # Extract meta data
-            meta_data = {
-                'start': entry['meta']['start'],
-                'end': entry['meta']['end'],
-                'Latitude': entry['meta']['_geolocation'][0],
-                'Longitude': entry['meta']['_geolocation'][1]
-            }
-
-            # Extract labeled result data
-            result_data = {
-                value['label']: value['answer_label']
-                for key, value in entry['results'].items()
-            }
-
-            # Combine meta data and result data
-            combined_data = {**meta_data, **result_data}
-            combined_rows.append(combined_data)
-
-        # Convert combined rows to a DataFrame
-        df = pd.DataFrame(combined_rows)
-
-        # Remove columns starting with "Time difference in"
-        df = df.loc[:, ~df.columns.str.startswith("Time difference in")]
-        return df
+# Yield the submissions of an asset page by page, using the start/limit
+# parameters of the Kobo v2 data endpoint, so only one page is held in
+# memory. `fields` and `sort` (JSON strings) are passed on when given.
+def iter_kobo_pages(user_uid, kobo=None, query=None, page_size=None,
+                    fields=None, sort=None):
+    kobo = kobo or get_kobo()
+    page_size = page_size or PAGE_SIZE
+    options = {}
+    if fields:
+        options['fields'] = fields
+    if sort:
+        options['sort'] = sort
+    start = 0
+    while True:
+        page = kobo.get_data(user_uid, query=query, start=start,
+                             limit=page_size, **options)
+        results = page.get('results') or []
+        if results:
+            yield results
+        # Stop on the last page. A short page is not the last one when the
+        # server caps `limit` below page_size.
+        if not page.get('next') or not results:
+            break
+        start += len(results)
+
+
+_sync_locks = {}
+_sync_locks_lock = threading.Lock()
+
+
+# Lock serializing the syncs of one asset, e.g. a user's load and the
+# prefetcher's
+def _sync_lock(user_uid):
+    with _sync_locks_lock:
+        return _sync_locks.setdefault(user_uid, threading.Lock())
+
+
+# Bring the local store of an asset up to date. The `_id` and instance id
+# of every submission on Kobo are listed first (a cheap query) and compared
+# with the store: submissions with an `_id` above the stored high-water mark
+# are downloaded, as are older ones whose instance id changed (edited on
+# Kobo), and those no longer on Kobo are removed. `full_refresh` downloads
+# every submission again.
+def sync_submissions(user_uid, kobo=None, full_refresh=False):
+    kobo = kobo or get_kobo()
+    with _sync_lock(user_uid), span('sync_submissions',
+                                    asset=user_uid) as record:
+        store = SubmissionStore(user_uid)
+        last_id, _ = store.high_water_mark()
+
+        if not full_refresh and last_id is not None:
+            listed = {}
+            for page in iter_kobo_pages(
+                    user_uid, kobo=kobo, page_size=SYNC_LIST_PAGE_SIZE,
+                    fields=json.dumps(['_id', INSTANCE_ID_FIELD])):
+                listed.update((result['_id'], result.get(INSTANCE_ID_FIELD))
+                              for result in page)
+            stored = store.instance_ids()
+            deleted = [i for i in stored if i not in listed]
+            edited = [i for i, instance_id in listed.items()
+                      if i in stored and stored[i] != instance_id]
+            store.delete(deleted)
+
+            queries = [{'$gt': last_id}]
+            queries += [{'$in': edited[i:i + SYNC_ID_BATCH]}
+                        for i in range(0, len(edited), SYNC_ID_BATCH)]
+            fetched = 0
+            for query in queries:
+                for page in iter_kobo_pages(
+                        user_uid, kobo=kobo,
+                        query=json.dumps({'_id': query})):
+                    store.merge(page)
+                    fetched += len(page)
+            record.set(rows=fetched, edited=len(edited),
+                       deleted=len(deleted), full=False)
+            return store
+
+        store.clear()
+        fetched = 0
+        for page in iter_kobo_pages(user_uid, kobo=kobo):
+            store.merge(page)
+            fetched += len(page)
+        record.set(rows=fetched, full=True)
+        return store
+
+
+# Yield the submissions of an asset page by page, either synced through the
+# local store or downloaded in full. Pages come in `_id` order, or ordered
+# by submission time with `by_time`.
+def iter_submission_pages(user_uid, kobo=None, incremental=None,
+                          page_size=None, by_time=False):
+    if incremental is None:
+        incremental = INCREMENTAL_SYNC
+    if incremental:
+        store = sync_submissions(user_uid, kobo=kobo)
+        if by_time:
+            return store.iter_pages_by_time(page_size or PAGE_SIZE)
+        return store.iter_pages(page_size or PAGE_SIZE)
+    return iter_kobo_pages(user_uid, kobo=kobo, page_size=page_size,
+                           sort=SUBMISSION_SORT if by_time else None)
+
+
+# Start fetching the schema of an asset in the background while the first
+# page of submissions is downloaded, so the first load waits for the slower
+# of the two calls rather than for both in turn. The schema is fetched in
+# the current trace, so its spans show up with the caller's. Filtered loads
+# (a `query` or `fields`, see build_submission_query) are sent to Kobo
+# directly instead of going through the local store; they come ordered by
+# submission time, like all pages with `by_time`.
+def fetch_schema_and_pages(user_uid, kobo=None, query=None, fields=None,
+                           by_time=False):
+    schema_future = get_io_executor().submit(traced(get_asset_schema),
+                                             user_uid, kobo=kobo)
+    if query or fields:
+        pages = iter_kobo_pages(user_uid, kobo=kobo, query=query,
+                                fields=fields, sort=SUBMISSION_SORT)
     else:
+        pages = iter_submission_pages(user_uid, kobo=kobo, by_time=by_time)
+    first_page = next(pages, None)
+    schema = schema_future.result()
+    if first_page is None:
+        return schema, iter(())
+    return schema, itertools.chain([first_page], pages)
+
+
+# Submission keys always requested with a field projection, since the
+# labeling and ordering of KII data need them
+SUBMISSION_FIELDS = ['_id', '_submission_time', 'start', 'end',
+                     '_geolocation']
+
+# Order of filtered downloads: by submission time like the app shows them,
+# then by `_id` so pages stay stable
+SUBMISSION_SORT = json.dumps({'_submission_time': 1, '_id': 1})
+
+
+# Kobo query (JSON string, or None for no filter) selecting the submissions
+# made between two dates (inclusive, either may be None; compared with the
+# UTC `_submission_time`) whose answers equal `equals` ({submission key:
+# answer code})
+def build_submission_query(start_date=None, end_date=None, equals=None):
+    query = dict(equals or {})
+    submission_time = {}
+    if start_date is not None:
+        submission_time['$gte'] = start_date.isoformat()
+    if end_date is not None:
+        next_day = pd.Timestamp(end_date) + pd.Timedelta(days=1)
+        submission_time['$lt'] = next_day.date().isoformat()
+    if submission_time:
+        query['_submission_time'] = submission_time
+    return json.dumps(query, sort_keys=True) if query else None
+
+
+# Field projection (JSON string, or None for all fields) loading only the
+# submission keys `paths` besides the ones KII labeling needs
+def build_submission_fields(paths):
+    if not paths:
         return None
+    return json.dumps(SUBMISSION_FIELDS +
+                      [path for path in paths
+                       if path not in SUBMISSION_FIELDS])
+
+
+# Name of a filtered KII selection, e.g. for its edit log ('' unfiltered)
+def kii_selection_name(query=None, fields=None):
+    if not (query or fields):
+        return ''
+    return f"query={query or ''}&fields={fields or ''}"
+
+
+# Label one page of KII submissions and flatten it into a DataFrame chunk
+def label_kii_page(results, choice_lists, questions, kobo=None):
+    kobo = kobo or get_kobo()
+    # List to store combined rows for each entry
+    combined_rows = []
+
+    # Process each labeled result
+    for result in results:
+        entry = kobo.label_result(
+            unlabeled_result=result,
+            choice_lists=choice_lists,
+            questions=questions,
+            unpack_multiples=True
+        )
+        # Extract meta data
+        meta_data = {
+            'start': entry['meta']['start'],
+            'end': entry['meta']['end'],
+            'Latitude': entry['meta']['_geolocation'][0],
+            'Longitude': entry['meta']['_geolocation'][1]
+        }
+
+        # Extract labeled result data
+        result_data = {
+            value['label']: value['answer_label']
+            for key, value in entry['results'].items()
+        }
+
+        # Combine meta data and result data
+        combined_data = {**meta_data, **result_data}
+        combined_rows.append(combined_data)
+
+    # Convert combined rows to a DataFrame
+    df = pd.DataFrame(combined_rows)
+
+    # Remove columns starting with "Time difference in"
+    return df.loc[:, ~df.columns.str.startswith("Time difference in")]
+
+
+# Submission keys label_result treats as metadata rather than questions
+META_PREFIXES = ('_', 'meta/', 'formhub/', 'simserial', 'phonenumber',
+                 'start', 'end', 'today', 'username', 'deviceid',
+                 'subscriberid')
+
+
+# Kinds of answer columns (as inferred by pandas) holding scalar answers only
+SCALAR_ANSWER_KINDS = ('string', 'empty', 'integer', 'floating',
+                       'mixed-integer-float', 'boolean')
+
+
+# Label, type and choice list of the question at `path` of a submission,
+# looked up like label_result does. Unknown questions are labeled with
+# their code and keep their answers (type None).
+def question_spec(path, questions):
+    group_codes = path.split('/')
+    code = group_codes.pop()
+    node = questions
+    for group_code in group_codes:
+        if group_code not in node['groups']:
+            return code, None, None
+        node = node['groups'][group_code]
+    if not ('questions' in node and code in node['questions']):
+        return code, None, None
+    question = node['questions'][code]
+    if 'label' not in question:
+        return code, None, None
+    return question['label'], question['type'], question.get('list_name')
+
+
+# Answer labels of a select_multiple answer: the choice labels of its codes,
+# each followed by ';', or the answer itself if a code has no label
+def multiple_choice_label(value, labels):
+    try:
+        return ''.join(labels[code] + ';' for code in value.split())
+    except KeyError:
+        return value
+
+
+# Text parts of Kobo geopoints ("latitude longitude altitude accuracy", as
+# in FGD locations), split for all values at once: a frame with the
+# latitude and longitude text in columns 0 and 1, None where a value is
+# missing or has fewer parts
+def split_geopoints(values):
+    text = pd.Series(values, dtype=object)
+    parts = text.str.split(n=2, expand=True).reindex(columns=[0, 1])
+    return parts.astype(object).where(parts.notna(), None)
+
+
+# Float Latitude and Longitude columns of Kobo geopoints (see
+# split_geopoints); missing or malformed points give NaN
+def parse_geopoints(values):
+    parts = split_geopoints(values)
+    return _coordinates(parts[0], parts[1])
+
+
+# Float Latitude and Longitude columns of Kobo `_geolocation` values
+# ([latitude, longitude] lists, [None, None] or missing without a location)
+def parse_geolocations(values):
+    points = pd.Series(values, dtype=object)
+    return _coordinates(points.str[0], points.str[1])
+
+
+def _coordinates(latitudes, longitudes):
+    return pd.DataFrame({
+        'Latitude': pd.to_numeric(latitudes, errors='coerce')
+        .astype('float64'),
+        'Longitude': pd.to_numeric(longitudes, errors='coerce')
+        .astype('float64'),
+    })
+
+
+# Columnar version of label_kii_page: the raw submissions become one column
+# per question path, answers are labeled once per column through the
+# schema's choice tables and the columns are merged under their question
+# labels. Gives the same frame as label_kii_page; pages label_result would
+# treat specially (repeat groups, missing metadata, inconsistent select
+# questions) go through label_kii_page.
+def label_kii_columns(results, schema, kobo=None):
+    raw = pd.DataFrame(results)
+    if (not len(raw) or not {'start', 'end'}.issubset(raw.columns) or
+            raw[['start', 'end']].isna().any().any()):
+        return label_kii_page(results, schema.choice_lists,
+                              schema.questions, kobo=kobo)
+
+    # Submissions without a location get NaN coordinates
+    coordinates = parse_geolocations(raw['_geolocation']
+                                     if '_geolocation' in raw.columns
+                                     else [None] * len(raw))
+    columns = {
+        'start': raw['start'],
+        'end': raw['end'],
+        'Latitude': coordinates['Latitude'],
+        'Longitude': coordinates['Longitude'],
+    }
+    for path in raw.columns:
+        if path.startswith(META_PREFIXES):
+            continue
+        label, question_type, list_name = question_spec(path,
+                                                        schema.questions)
+        if label.startswith("Time difference in"):
+            continue
+        answers = raw[path]
+        kind = pd.api.types.infer_dtype(answers, skipna=True)
+        if kind not in SCALAR_ANSWER_KINDS or (
+                question_type == 'select_multiple' and
+                (kind not in ('string', 'empty') or
+                 list_name not in schema.choice_lists)):
+            # Repeat groups (lists of answers) and select_multiple answers
+            # label_result cannot label are left to it
+            return label_kii_page(results, schema.choice_lists,
+                                  schema.questions, kobo=kobo)
+
+        if question_type == 'select_one':
+            labels = schema.choice_labels.get(list_name, {})
+            labeled = answers.map(labels)
+            answers = labeled.where(labeled.notna(), answers)
+        elif question_type == 'select_multiple':
+            labels = schema.choice_labels[list_name]
+            answers = answers.map(
+                {value: multiple_choice_label(value, labels)
+                 for value in answers.dropna().unique()})
+
+        # Later questions with the same label overwrite earlier answers
+        if label in columns:
+            answers = answers.where(answers.notna(), columns[label])
+        columns[label] = answers
+
+    return pd.DataFrame(columns).infer_objects()
+
+
+# Labeled KII data of an asset, optionally only the submissions matching a
+# Kobo `query` and only the question `fields` (see build_submission_query
+# and build_submission_fields), selected by Kobo before downloading
+def get_kii_data(user_uid, kobo=None, query=None, fields=None):
+    with span('get_kii_data', asset=user_uid,
+              filtered=bool(query or fields)) as record:
+        # Get the compiled schema of the asset and the submissions at once
+        schema, pages = fetch_schema_and_pages(user_uid, kobo=kobo,
+                                               query=query, fields=fields)
+
+        # Label and flatten the data page by page as it arrives, keeping
+        # the submission times to order the rows at the end
+        chunks = []
+        submission_times = []
+        for page in pages:
+            submission_times.extend(result['_submission_time']
+                                    for result in page)
+            with span('label_kii_page', rows=len(page)) as label:
+                chunks.append(label_kii_columns(page, schema, kobo=kobo))
+                label.set(cols=chunks[-1].shape[1])
+
+        # Check if data is available
+        if not chunks:
+            record.set(rows=0)
+            return None
+
+        df = pd.concat(chunks, ignore_index=True)
+        del chunks
+
+        # Sort rows by submission time (stable, like sort_results_by_time)
+        if submission_times != sorted(submission_times):
+            order = sorted(range(len(submission_times)),
+                           key=submission_times.__getitem__)
+            df = df.iloc[order].reset_index(drop=True)
+        record.set(rows=df.shape[0], cols=df.shape[1])
+        return df
 
 
 # FGD functions
@@ -131,216 +683,1424 @@ def extract_and_clean_labels(data):
     return result
 
 
-# Create a downloadable xlsx file
-def create_excel_file(df, sheet_name='Sheet1'):
-    sheet_name = sheet_name[:31]
-    # Create an Excel file in memory
-    output = BytesIO()
-
-    # Use XlsxWriter as the engine to apply formatting
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name=sheet_name)
-
-        # Access the XlsxWriter workbook and worksheet objects
-        workbook = writer.book
-        worksheet = writer.sheets[sheet_name]
-
-        # Define a format with text wrapping and borders
-        wrap_border_format = workbook.add_format({
-            'text_wrap': True,
-            'border': 1  # Adds a border around cells
-        })
+# Question label -> choice list name of the select_one and select_multiple
+# questions of get_questions' output
+def extract_select_questions(questions):
+    result = {}
+    def traverse(node):
+        for question in node.get('questions', {}).values():
+            if (question.get('type') in ('select_one', 'select_multiple')
+                    and 'label' in question):
+                result[question['label']] = question['list_name']
+        for group in node.get('groups', {}).values():
+            traverse(group)
+    traverse(questions)
+    return result
 
-        # Set a fixed column width (e.g., 20) for each column
-        if len(df.columns) >= 4:
-            fixed_width = 20
-        else:
-            fixed_width = 40
-        for col_num, _ in enumerate(df.columns):
-            worksheet.set_column(col_num, col_num, fixed_width)
-
-        # Apply the wrap and border format only to cells containing data
-        for row in range(len(df)):
-            for col in range(len(df.columns)):
-                cell_value = df.iloc[row, col]
-                # Check if cell_value is NaN or INF and only use np.isinf() for numbers
-                if pd.isna(cell_value) or (isinstance(cell_value, (int, float)) and np.isinf(cell_value)):
-                    worksheet.write(row + 1, col, '', wrap_border_format)  # Write empty cell for NaN/INF
-                else:
-                    worksheet.write(row + 1, col, cell_value, wrap_border_format)  # Adjust for header row
-
-    output.seek(0)  # Move the cursor back to the beginning of the file
 
+# Submission key -> question ('label', 'type', 'list_name') of the labeled
+# questions of get_questions' output outside repeat groups, in form order
+def extract_question_paths(questions):
+    result = []
+    def traverse(node, prefix):
+        for code, question in node.get('questions', {}).items():
+            if 'label' in question:
+                result.append((question['sequence'], prefix + code,
+                               question))
+        for code, group in node.get('groups', {}).items():
+            if not group.get('repeat'):
+                traverse(group, f"{prefix}{code}/")
+    traverse(questions, '')
+    return {path: question for _, path, question in sorted(result)}
+
+
+# Lookup tables of an asset, compiled once per deployed version and shared
+# by the KII and FGD pipelines:
+#   column_list_names: column -> choice list name
+#   column_labels: column -> cleaned question label
+#   choice_labels: choice list name -> choice code -> choice label
+class AssetSchema:
+    def __init__(self, asset, kobo=None):
+        kobo = kobo or get_kobo()
+        self.version = (asset.get('deployed_version_id') or
+                        asset.get('version_id'))
+        self.choice_lists = kobo.get_choices(asset)
+        self.questions = kobo.get_questions(asset=asset,
+                                            unpack_multiples=True)
+        self.choice_labels = {
+            list_name: {code: choice['label']
+                        for code, choice in choices.items()}
+            for list_name, choices in self.choice_lists.items()
+        }
+
+        # FGD questions live in the groups of 'consented_grp'
+        groups = (self.questions.get('groups', {})
+                  .get('consented_grp', {}).get('groups', {}))
+        self.column_list_names = extract_list_names(groups)
+        self.column_labels = {
+            key: value
+            for key, value in extract_and_clean_labels(groups).items()
+            if 'section_' not in key
+        }
+
+        # KII columns are named by question label: label -> choice labels
+        # of the select questions
+        self.question_choice_labels = {
+            label: [choice['label'] for choice
+                    in self.choice_lists.get(list_name, {}).values()]
+            for label, list_name in extract_select_questions(
+                self.questions).items()
+        }
+
+        # Submission key -> question of the questions outside repeat
+        # groups, in form order (used to filter KII loads)
+        self.question_paths = extract_question_paths(self.questions)
+
+
+# Get the compiled schema of an asset. The deployed version is read from the
+# cached asset list, so an unchanged form costs neither a network call nor a
+# recompilation.
+def get_asset_schema(user_uid, kobo=None):
+    kobo = kobo or get_kobo()
+    version = get_asset_info(user_uid).get('deployed_version_id')
+    if version is None:
+        asset = kobo.get_asset(user_uid)
+        schema = AssetSchema(asset, kobo=kobo)
+        _schema_cache.set((user_uid, schema.version), schema)
+        return schema
+    return _schema_cache.get_or_compute(
+        (user_uid, version),
+        lambda: AssetSchema(kobo.get_asset(user_uid), kobo=kobo))
+
+
+# Columns compacted to float32 and to datetimes by compact_frame
+COORDINATE_COLUMNS = ('Latitude', 'Longitude')
+TIMESTAMP_COLUMNS = ('start', 'end')
+
+
+# Deep memory usage of a frame in bytes
+def frame_memory(df):
+    return int(df.memory_usage(deep=True, index=False).sum())
+
+
+_object_sizes = np.frompyfunc(sys.getsizeof, 1, 1)
+
+
+# Quick estimate of frame_memory: the Python objects of object columns are
+# measured on a sample of cells instead of one by one
+def estimate_memory(df, sample=10000):
+    is_object = (df.dtypes == object).to_numpy()
+    size = 0
+    if not is_object.all():
+        size += frame_memory(df.loc[:, ~is_object])
+    if is_object.any():
+        objects = df if is_object.all() else df.loc[:, is_object]
+        values = objects.to_numpy().ravel()
+        size += values.itemsize * len(values)
+        if len(values):
+            cells = np.random.default_rng(0).integers(
+                0, len(values), size=min(sample, len(values)))
+            size += int(_object_sizes(values[cells]).mean() * len(values))
+    return size
+
+
+# Approximate memory of a cached value (a frame, a dict of frames, ...),
+# the size counted against DATA_CACHE_MB
+def cached_size(value):
+    if isinstance(value, pd.DataFrame):
+        return estimate_memory(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            sys.getsizeof(key) + cached_size(item)
+            for key, item in value.items())
+    return sys.getsizeof(value)
+
+
+# Kobo's text form of timestamps: milliseconds and a +HH:MM offset. Parsed
+# ISO 8601 text always has a single fixed offset per column.
+def format_timestamps(col):
+    offset = ''
+    if col.dt.tz is not None:
+        minutes = int(col.dt.tz.utcoffset(None).total_seconds()) // 60
+        sign = '-' if minutes < 0 else '+'
+        offset = f"{sign}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}"
+        col = col.dt.tz_localize(None)
+    text = np.datetime_as_string(col.to_numpy(dtype='datetime64[ms]'),
+                                 unit='ms')
+    text = pd.Series(text, index=col.index, dtype=object) + offset
+    return text.where(col.notna(), math.nan)
+
+
+# The float64 values a float32 column was compacted from
+def widen_floats(col):
+    return col.astype(str).astype('float64')
+
+
+# Compacted form of one column, or the column itself when no conversion
+# gives back exactly the same values through expand_column
+def compact_column(name, col, choice_labels=None):
+    if name in COORDINATE_COLUMNS and col.dtype == 'float64':
+        narrow = col.astype('float32')
+        return narrow if widen_floats(narrow).equals(col) else col
+    if col.dtype != object:
+        return col
+
+    if name in TIMESTAMP_COLUMNS:
+        with warnings.catch_warnings():
+            # Mixed offsets give an object column, which is not used
+            warnings.simplefilter('ignore', FutureWarning)
+            try:
+                parsed = pd.to_datetime(col, format='ISO8601')
+            except (ValueError, TypeError):
+                parsed = None
+        if (parsed is not None and
+                pd.api.types.is_datetime64_any_dtype(parsed) and
+                format_timestamps(parsed).equals(col)):
+            return parsed
+
+    if choice_labels is not None:
+        # Answers outside the choice list (e.g. unlabeled codes or select
+        # multiple combinations) are added as categories of their own
+        try:
+            observed = pd.unique(col.dropna())
+        except TypeError:
+            return col
+        categories = list(dict.fromkeys([*choice_labels, *observed]))
+        return pd.Series(pd.Categorical(col, categories=categories),
+                         index=col.index, name=col.name)
+
+    if pd.api.types.infer_dtype(col, skipna=True) == 'string':
+        return col.astype(pd.StringDtype('pyarrow'))
+    return col
+
+
+# Original (object/float64) form of a column made by compact_column
+def expand_column(col):
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.astype(object)
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return format_timestamps(col)
+    if col.dtype == 'float32':
+        return widen_floats(col)
+    if isinstance(col.dtype, pd.StringDtype):
+        return col.astype(object).where(col.notna(), math.nan)
+    return col
+
+
+# Compact a labeled frame: answers of select questions become categories
+# (`choice_labels` maps a column to the labels of its choice list),
+# coordinates float32, start/end datetimes and other text Arrow-backed
+# strings. Each conversion is only made when it is lossless, so a compacted
+# frame exports exactly like the original (write_excel_sheet expands it
+# back).
+def compact_frame(df, choice_labels=None):
+    choice_labels = choice_labels or {}
+    compacted = df.copy(deep=False)
+    for position, (name, col) in enumerate(df.items()):
+        compacted.isetitem(position, compact_column(
+            name, col, choice_labels.get(name)))
+    return compacted
+
+
+# The frame with every compacted column back in its original form; frames
+# without compacted columns are returned as they are
+def expand_frame(df):
+    expanded = None
+    for position, (name, col) in enumerate(df.items()):
+        original = expand_column(col)
+        if original is not col:
+            if expanded is None:
+                expanded = df.copy(deep=False)
+            expanded.isetitem(position, original)
+    return df if expanded is None else expanded
+
+
+# A frame with respondents in rows (such as the KII data) turned to
+# questions in rows and respondents in columns, the questions in the first
+# column, as the app shows and exports it; compacted columns are expanded
+def questions_in_rows(df):
+    return expand_frame(df).astype(object).T.reset_index()
+
+
+# The `columns` (positions) and `rows` (a slice) of a frame; only that part
+# of a StoredFrame is read from its file
+def read_frame(df, columns=None, rows=None):
+    if isinstance(df, StoredFrame):
+        return df.read(columns=columns, rows=rows)
+    columns = slice(None) if columns is None else list(columns)
+    return df.iloc[rows if rows is not None else slice(None), columns]
+
+
+# A frame as a pandas frame, a StoredFrame being read whole
+def materialize(df):
+    return df.read() if isinstance(df, StoredFrame) else df
+
+
+# Compact a frame for the in-process cache when COMPACT_DTYPES is set,
+# recording its memory before and after under `report_key`
+def compact_cached_frame(df, report_key, choice_labels=None):
+    if not COMPACT_DTYPES or df is None:
+        return df
+    with span('compact_frame', rows=df.shape[0], cols=df.shape[1]) as record:
+        before = frame_memory(df)
+        df = compact_frame(df, choice_labels)
+        after = frame_memory(df)
+        record.set(bytes_before=before, bytes=after)
+    _memory_reports.set(report_key, (before, after))
+    return df
+
+
+# Memory of a compacted cached frame before and after compaction, as text
+# (None if the frame was not compacted)
+def get_memory_report(*report_key):
+    report = _memory_reports.get(report_key)
+    if report is None:
+        return None
+    before, after = report
+    saved = 1 - after / before if before else 0
+    return (f"Memory: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB "
+            f"compacted ({saved:.0%} less)")
+
+
+# Header format used by pandas' to_excel, kept so exported workbooks look
+# the same as before
+HEADER_FORMAT = {'bold': True, 'align': 'center', 'valign': 'top',
+                 'top': 1, 'right': 1, 'bottom': 1, 'left': 1}
+
+
+# Size of an Excel worksheet, header row included
+EXCEL_MAX_ROWS = 1048576
+EXCEL_MAX_COLUMNS = 16384
+
+
+# Valid, unique worksheet name: Excel forbids []:*?/\, an apostrophe at
+# either end and the name History (reserved), and allows at most 31
+# characters
+def unique_sheet_name(name, taken):
+    base = re.sub(r'[\[\]:*?/\\]', '', str(name)).strip("'")
+    base = base[:31].rstrip("'") or 'Sheet'
+    sheet_name = base
+    suffix = 1
+    while sheet_name.lower() in taken or sheet_name.lower() == 'history':
+        tail = f"_{suffix}"
+        sheet_name = base[:31 - len(tail)] + tail
+        suffix += 1
+    taken.add(sheet_name.lower())
+    return sheet_name
+
+
+# Write one frame to a new worksheet. Cells are written in bulk: one
+# write_column call per column, or one write_row call per row in
+# constant_memory mode (which requires row order and keeps memory flat for
+# very large sheets). NaN/INF cells are blanked through a mask computed once
+# for the whole frame. Frames larger than a worksheet raise ValueError
+# rather than being cut silently.
+def write_excel_sheet(workbook, df, sheet_name, header_format,
+                      wrap_border_format, constant_memory=False):
+    if df.shape[1] > EXCEL_MAX_COLUMNS or len(df) >= EXCEL_MAX_ROWS:
+        raise ValueError(
+            f"{sheet_name}: {len(df)} rows x {df.shape[1]} columns do not "
+            f"fit in an Excel sheet ({EXCEL_MAX_ROWS - 1} rows and "
+            f"{EXCEL_MAX_COLUMNS} columns at most)")
+    worksheet = workbook.add_worksheet(sheet_name)
+
+    # Set a fixed column width (e.g., 20) for each column
+    if len(df.columns) >= 4:
+        fixed_width = 20
+    else:
+        fixed_width = 40
+    if len(df.columns):
+        worksheet.set_column(0, len(df.columns) - 1, fixed_width)
+
+    # Replace NaN and INF with empty cells in one pass over the frame
+    values = expand_frame(df).astype(object)
+    mask = values.isna() | values.isin([math.inf, -math.inf])
+    values = values.mask(mask, '').to_numpy()
+
+    # Write the header and apply the wrap and border format only to cells
+    # containing data
+    worksheet.write_row(0, 0, list(df.columns), header_format)
+    if constant_memory:
+        for row in range(len(values)):
+            worksheet.write_row(row + 1, 0, values[row].tolist(),
+                                wrap_border_format)
+    else:
+        for col in range(values.shape[1]):
+            worksheet.write_column(1, col, values[:, col].tolist(),
+                                   wrap_border_format)
+    return worksheet
+
+
+# Create a downloadable xlsx file with one sheet per frame of `frames`: a
+# dict of sheet name -> DataFrame, or an iterable of (sheet name, DataFrame)
+# pairs such as a generator building the frames one at a time. The workbook
+# is written to `output` (a file path or binary file), or in memory when
+# `output` is None. Returns `output`, or the BytesIO holding the workbook.
+def create_excel_workbook(frames, constant_memory=False, output=None):
+    if isinstance(frames, dict):
+        frames = frames.items()
+    with span('create_excel', constant_memory=constant_memory) as record:
+        output = _create_excel_workbook(frames, constant_memory, output,
+                                        record)
+        if isinstance(output, BytesIO):
+            record.set(bytes=output.getbuffer().nbytes)
+        elif isinstance(output, str):
+            record.set(bytes=os.path.getsize(output))
     return output
 
-# Make edits on dataframe
-def editable_dataframe(df):
-    # Display an editable DataFrame
-    edited_df = st.data_editor(df, num_rows="dynamic", hide_index=True,
-                               use_container_width=True, width=2000)
+
+def _create_excel_workbook(frames, constant_memory, output, record):
+    import xlsxwriter
+
+    # Create an Excel file in memory unless a target is given
+    in_memory = output is None
+    if in_memory:
+        output = BytesIO()
+
+    workbook = xlsxwriter.Workbook(output,
+                                   {'constant_memory': constant_memory})
+    header_format = workbook.add_format(HEADER_FORMAT)
+
+    # Define a format with text wrapping and borders
+    wrap_border_format = workbook.add_format({
+        'text_wrap': True,
+        'border': 1  # Adds a border around cells
+    })
+
+    taken = set()
+    sheets = rows = cols = 0
+    try:
+        for sheet_name, df in frames:
+            write_excel_sheet(workbook, df,
+                              unique_sheet_name(sheet_name, taken),
+                              header_format, wrap_border_format,
+                              constant_memory=constant_memory)
+            sheets += 1
+            rows += len(df)
+            cols += df.shape[1]
+    finally:
+        record.set(sheets=sheets, rows=rows, cols=cols)
+        workbook.close()
+
+    if in_memory:
+        output.seek(0)  # Move the cursor back to the beginning of the file
+
+    return output
+
+
+# Create a downloadable xlsx file
+def create_excel_file(df, sheet_name='Sheet1', constant_memory=False):
+    return create_excel_workbook({sheet_name: df},
+                                 constant_memory=constant_memory)
+
+# Shallow copy of a frame with blank column names, for display and export
+# without touching the (possibly cached) original
+def without_column_names(df):
+    df = df.copy(deep=False)
+    df.columns = [''] * len(df.columns)
+    return df
+
+
+# Content hash of a frame (values, labels and dtypes) and the extra `parts`,
+# e.g. the sheet name of its workbook. Columns are hashed one dtype at a
+# time in bulk; object values are hashed with their type, so 1 and '1' differ.
+def frame_digest(df, *parts):
+    values = expand_frame(df)
+    digest = hashlib.sha1()
+    by_dtype = {}
+    for position, dtype in enumerate(values.dtypes):
+        by_dtype.setdefault(str(dtype), []).append(position)
+    for dtype, positions in sorted(by_dtype.items()):
+        block = values.iloc[:, positions].to_numpy().ravel(order='F')
+        if dtype == 'object':
+            digest.update(pd.util.hash_array(
+                _type_names(block), categorize=False).tobytes())
+            try:
+                hashed = pd.util.hash_array(block, categorize=False)
+            except (TypeError, ValueError):
+                # Unhashable answers (e.g. lists) are hashed by their text
+                hashed = pd.util.hash_array(_texts(block), categorize=False)
+        else:
+            hashed = pd.util.hash_array(block, categorize=False)
+        digest.update(json.dumps([dtype, positions]).encode('utf-8'))
+        digest.update(hashed.tobytes())
+    digest.update(pd.util.hash_pandas_object(values.index).to_numpy()
+                  .tobytes())
+    digest.update(json.dumps([list(map(str, values.columns)), parts],
+                             default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+_type_names = np.frompyfunc(lambda value: type(value).__name__, 1, 1)
+_texts = np.frompyfunc(str, 1, 1)
+
+
+# Sidebar download of `df` (a frame or a StoredFrame) as an Excel file, or
+# of questions_in_rows(df) when `transposed` is set, with blank column
+# names. The workbook is only
+# built when the user asks for it and is kept, once per content and sheet
+# name, in a cache bounded by total size; the session then keeps offering
+# the same file while `df` (a cached frame) is unchanged.
+def excel_download_button(df, sheet_name, file_name, key, transposed=False):
+    import streamlit as st
+
+    n_rows, n_columns = (df.shape[1], len(df) + 1) if transposed else df.shape
+    if n_columns > EXCEL_MAX_COLUMNS or n_rows >= EXCEL_MAX_ROWS:
+        st.sidebar.info("Too large for an Excel sheet, export the data as "
+                        "CSV or Parquet instead.")
+        return
+
+    state_key = f"{key}_excel"
+    prepared = st.session_state.get(state_key)
+    data = None
+    if prepared and prepared[0] is df:
+        data = _excel_files.get(prepared[1])
+    if data is None:
+        if not st.sidebar.button("Prepare Excel download",
+                                 key=f"{key}_prepare"):
+            return
+
+        frame = materialize(df)
+
+        def build():
+            table = questions_in_rows(frame) if transposed else frame
+            return create_excel_file(without_column_names(table),
+                                     sheet_name=sheet_name).getvalue()
+        digest = frame_digest(frame, sheet_name, transposed)
+        data = _excel_files.get_or_compute(digest, build)
+        st.session_state[state_key] = (df, digest)
+
+    st.sidebar.download_button(
+        label="Download data as Excel",
+        data=data,
+        file_name=file_name,
+        mime="application/vnd.openxmlformats-officedocument"
+             ".spreadsheetml.sheet",
+        key=f"{key}_download")
+
+
+# Sidebar controls selecting the KII submissions and questions to load: a
+# submission date range, an answer to match and the questions to keep.
+# Returns the (query, fields) to pass to the KII loaders, (None, None) when
+# nothing is selected.
+def kii_filter_controls(user_uid, key):
+    import streamlit as st
+
+    schema = get_asset_schema(user_uid)
+    questions = {path: question
+                 for path, question in schema.question_paths.items()
+                 if not path.startswith(META_PREFIXES) and
+                 question.get('type') not in ('note', 'calculate')}
+
+    with st.sidebar.expander("Filter submissions"):
+        dates = st.date_input("Submitted between", value=(),
+                              key=f"{key}_dates")
+        start_date = dates[0] if len(dates) > 0 else None
+        end_date = dates[1] if len(dates) > 1 else start_date
+
+        equals = {}
+        path = st.selectbox("Where question", list(questions), index=None,
+                            format_func=lambda path:
+                            questions[path]['label'],
+                            key=f"{key}_where")
+        if path is not None:
+            question = questions[path]
+            choices = schema.choice_labels.get(question.get('list_name'))
+            if question['type'] == 'select_one' and choices:
+                answer = st.selectbox("equals", list(choices), index=None,
+                                      format_func=choices.get,
+                                      key=f"{key}_equals_{path}")
+            else:
+                answer = st.text_input("equals",
+                                       key=f"{key}_equals_{path}") or None
+            if answer is not None:
+                equals[path] = answer
+
+        paths = st.multiselect("Questions to load (all if empty)",
+                               list(questions),
+                               format_func=lambda path:
+                               questions[path]['label'],
+                               key=f"{key}_fields")
+
+    return (build_submission_query(start_date, end_date, equals),
+            build_submission_fields(paths))
+
+
+# Show a window of a frame with questions in rows and respondents in
+# columns (the first column holds the questions), or of a frame with
+# respondents in rows when `transposed` is set (shown as questions_in_rows
+# would turn it; it can then be a StoredFrame, of which only the window is
+# read). Only the visible slice is expanded and turned into HTML, so
+# rendering costs the same for any project size. The sidebar offers a
+# question search, a question page and a jump to a respondent.
+def windowed_view(df, key, rows=None, columns=None, transposed=False):
+    import streamlit as st
+
+    rows = rows or VIEW_ROWS
+    columns = columns or VIEW_COLUMNS
+    if transposed:
+        questions = pd.Series(df.columns)
+        n_respondents = len(df)
+    else:
+        questions = df.iloc[:, 0]
+        n_respondents = df.shape[1] - 1
+
+    # Keep only the questions matching the search text
+    search = st.sidebar.text_input("Search questions", key=f"{key}_search")
+    if search:
+        matches = questions.astype(str).str.contains(
+            search, case=False, regex=False)
+        positions = matches.to_numpy().nonzero()[0]
+    else:
+        positions = range(len(questions))
+
+    # Window position, the page is reset whenever the search changes
+    n_pages = max(1, -(-len(positions) // rows))
+    page = st.sidebar.number_input(
+        f"Question page (1-{n_pages})", min_value=1, max_value=n_pages,
+        value=1, step=1, key=f"{key}_page_{search}")
+    first = st.sidebar.number_input(
+        f"Jump to respondent (1-{max(n_respondents, 1)})", min_value=1,
+        max_value=max(n_respondents, 1), value=1, step=1,
+        key=f"{key}_respondent")
+
+    # Slice the window out of the frame
+    row_positions = positions[(page - 1) * rows:page * rows]
+    last = min(first + columns, n_respondents + 1)
+    respondents = range(first, last)
+    with span('render_view', rows=len(row_positions),
+              cols=len(respondents) + 1):
+        if transposed:
+            window = questions_in_rows(read_frame(
+                df, columns=row_positions, rows=slice(first - 1, last - 1)))
+        else:
+            window = expand_frame(
+                df.iloc[row_positions, [0, *respondents]])
+        window.columns = [''] + [f"Respondent {col}" for col in respondents]
+
+        st.markdown(window.to_html(escape=False), unsafe_allow_html=True)
+    if not len(row_positions):
+        st.caption(f"No questions match '{search}'")
+    else:
+        matching = (f"{len(positions)} matching" if search
+                    else len(questions))
+        st.caption(f"Question page {page} of {n_pages} ({matching} "
+                   f"questions), respondents {first}-{last - 1} of "
+                   f"{n_respondents}")
+
+
+# Replay committed edit deltas (see EditLog) on a base frame. The base is
+# only copied when there is something to apply, so it can be a cached frame.
+# Rows are found by the question label recorded with the commit, so edits
+# follow their question when rows move (e.g. after a form redeploy). Patches
+# whose row or column is no longer in the frame are skipped and described in
+# `skipped` (a list) rather than applied to the wrong cell.
+def apply_edits(df, commits, skipped=None):
+    if not commits:
+        return df
+    if skipped is None:
+        skipped = []
+    df = df.reset_index(drop=True)
+    for number, commit in enumerate(commits, 1):
+        # The data editor names columns by their string form
+        positions = {str(column): i for i, column in enumerate(df.columns)}
+        # Rows are found before any patch changes their labels
+        questions = commit.get('questions', {})
+        rows = {str(row): _edited_row(df, row, questions.get(str(row)))
+                for row in [*commit['edited_rows'], *commit['deleted_rows']]}
+        for row, cells in commit['edited_rows'].items():
+            position = rows[str(row)]
+            for column, value in cells.items():
+                if position is None or column not in positions:
+                    skipped.append(_skipped_edit(number, row, questions,
+                                                 column))
+                    continue
+                df.iat[position, positions[column]] = value
+        # Same order as the data editor: deletions, then additions
+        deleted = []
+        for row in commit['deleted_rows']:
+            position = rows[str(row)]
+            if position is None:
+                skipped.append(_skipped_edit(number, row, questions))
+            else:
+                deleted.append(position)
+        if deleted:
+            df = df.drop(df.index[deleted])
+        if commit['added_rows']:
+            added = pd.DataFrame(
+                [[row.get(column) for column in positions]
+                 for row in commit['added_rows']],
+                columns=df.columns, dtype=object)
+            df = pd.concat([df, added])
+        df = df.reset_index(drop=True)
+    return df
+
+
+# Position of an edited row of `df`: the row at the recorded position if it
+# still holds `label`, else the only row holding it (None if there is no
+# such row). Commits without labels only check the position is in range.
+def _edited_row(df, row, label):
+    position = int(row)
+    in_range = 0 <= position < len(df)
+    if label is None or not df.shape[1]:
+        return position if in_range else None
+    if in_range and df.iat[position, 0] == label:
+        return position
+    matches = np.flatnonzero(df.iloc[:, 0].to_numpy(dtype=object) == label)
+    return int(matches[0]) if len(matches) == 1 else None
+
+
+def _skipped_edit(number, row, questions, column=None):
+    question = questions.get(str(row)) or f"row {int(row) + 1}"
+    if column is None:
+        return f"commit {number}: deletion of '{question}'"
+    return f"commit {number}: '{question}' / {column}"
+
+
+# Edit log of a KII project (frame_name '') or of one FGD verification
+def get_edit_log(user_uid, frame_name=''):
+    return EditLog(user_uid, frame_name)
+
+
+# Make edits on dataframe. Commits are appended to the edit log as deltas
+# and replayed on top of `df`, so edits survive reruns and restarts while
+# `df` itself stays the cached frame (a StoredFrame is read whole); with
+# `transposed` set, the frame shown
+# and edited is questions_in_rows(df). Returns the reviewed frame
+# (read-only, it is kept between reruns), or None while nothing has been
+# committed.
+def editable_dataframe(df, edit_log, key=None, transposed=False):
+    import streamlit as st
+
+    key = key or f"{edit_log.asset_uid}_{edit_log.frame_name}"
+    commits = edit_log.load()
+    token = json.loads(json.dumps(get_freshness_token(edit_log.asset_uid)))
+
+    # Replaying the log once per commit is enough, keep the result
+    reviewed_key = f"{key}_reviewed"
+    cached = st.session_state.get(reviewed_key)
+    if cached and cached[0] is df and cached[1] == len(commits):
+        reviewed_df, skipped = cached[2], cached[3]
+    else:
+        # Edits are made on the original dtypes of compacted frames. A log
+        # that cannot be replayed must not hide the Discard button below.
+        skipped = []
+        frame = materialize(df)
+        base = (questions_in_rows(frame) if transposed
+                else expand_frame(frame))
+        try:
+            reviewed_df = apply_edits(base, commits, skipped)
+        except Exception as e:
+            reviewed_df = base
+            skipped = [f"the edits could not be replayed ({e})"]
+        st.session_state[reviewed_key] = (df, len(commits), reviewed_df,
+                                          skipped)
+    if skipped:
+        st.sidebar.warning(
+            f"{len(skipped)} committed edit(s) no longer match the data and "
+            "were skipped: " + "; ".join(skipped[:5]) +
+            ("; ..." if len(skipped) > 5 else ""))
+    if any(commit.get('token', token) != token for commit in commits):
+        st.sidebar.warning(
+            "The data changed on Kobo since some edits were committed; "
+            "check that they still apply to the right respondents.")
+
+    # Display an editable DataFrame, a new widget per revision of the log
+    # so the pending changes always apply to the frame shown
+    editor_key = f"{key}_editor_{len(commits)}"
+    with span('render_editor', rows=reviewed_df.shape[0],
+              cols=reviewed_df.shape[1], commits=len(commits)):
+        st.data_editor(reviewed_df, num_rows="dynamic", hide_index=True,
+                       use_container_width=True, width=2000, key=editor_key)
 
     # Add a button to commit changes
-    if st.sidebar.button("Commit Changes"):
-        # Create a new DataFrame with the edits
-        new_df = edited_df.copy()
+    if st.sidebar.button("Commit Changes", key=f"{key}_commit"):
+        if edit_log.append(st.session_state[editor_key],
+                           questions=reviewed_df.iloc[:, 0].tolist(),
+                           token=token):
+            st.session_state[f"{key}_committed"] = True
+            st.rerun()
+        st.sidebar.info("No changes to commit.")
+    if st.session_state.pop(f"{key}_committed", False):
         st.sidebar.success("Changes committed successfully!")
-        return new_df
-    else:
-        return None  # Return None if changes aren't committed
-
-
-def generate_dataframes(user_id):
-    # Fetch data using kobo API methods
-    data = kobo.get_data(user_id)
-
-    # Check if data is empty and return an empty list if so
-    if not data or 'results' not in data or not data['results']:
-        return []  # Return an empty list if data is empty or has no results
-
-    asset = kobo.get_asset(user_id)
-    choice_lists = kobo.get_choices(asset)
-    questions = kobo.get_questions(asset=asset, unpack_multiples=True)
-
-    # Initialize an empty dictionary to store each df created with dynamic names
-    df_lists = {}
-
-    # Loop through data['results'] to get the data
-    for index, entry in enumerate(data['results']):
-        # Get the data for individual verification
-        data1 = data['results'][index]
-        # Filter the data based on dictionary
-        filtered_dict = {key: value for key, value in data1.items()
-                         if isinstance(value, list) and
-                         any(isinstance(i, dict) for i in value)}
-
-        # Initialize an empty list to store each DataFrame created in the loop
-        df_list = []
-
-        # Loop through and create the DataFrame
-        for i in filtered_dict:
-            # Create DataFrame by normalizing JSON data
-            df2 = pd.json_normalize(filtered_dict[i])
-
-            # Drop columns that end with '_index'
-            df2 = df2[df2.columns.drop(list(df2.filter(regex='_index$')))]
-
-            # Append df2 to the list
-            df_list.append(df2)
-        df1 = pd.concat(df_list, axis=1)
-
-        # Get the number of rows of the DataFrame
-        nrows = df1.shape[0]
-
-        # Get and append the latitudes and longitudes in the df
-        precise_location = entry.get(
-            'consented_grp/section_b/precise_location')
-        if precise_location:
-            location_parts = precise_location.split()
-        lat = [location_parts[0] for _ in range(nrows)]
-        lon = [location_parts[1] for _ in range(nrows)]
-
-        # Add the latitudes and longitudes
-        df1.insert(0, 'Longitude', lon)
-        df1.insert(0, 'Latitude', lat)
-
-        # Get start and end dates
-        start_dates = [entry.get('start') for _ in range(nrows)]
-        end_dates = [entry.get('end') for _ in range(nrows)]
-
-        # Add the start and end dates
-        df1.insert(0, 'End', end_dates)
-        df1.insert(0, 'Start', start_dates)
-
-        # Clean the columns
-        cols = [col for col in df1.columns if
-                col.startswith('consented_grp')]
-
-        # Extract the third value from each string if it has at least three parts
-        fourth_values = [item.split('/')[-1] for item in cols]
-
-        columns_cleaned = ['start', 'end', 'Latitude', 'Longitude']
-        for i in fourth_values:
-            columns_cleaned.append(i)
-
-        # Rename columns for df
-        df1.columns = columns_cleaned
-
-        # Get questions
-        questions1 = questions['groups']['consented_grp']['groups']
-        list_name_labels = extract_list_names(questions1)
-
-        # Iterate over the list_name_keys to modify the appropriate columns in df
-        for col, list_name in list_name_labels.items():
-            if col in df1.columns and list_name in choice_lists:
-                # Replace the numeric values in the column with the
-                # corresponding labels from choice_lists
-                df1[col] = df1[col].astype(str).map(
-                    lambda x: choice_lists[list_name].get(x, {}).get(
-                        'label', x))
-
-        questions2 = extract_and_clean_labels(questions1)
-        questions2 = {key: value for key, value in questions2.items() if
-                      'section_' not in key}
-        filtered_list_name_labels = {k: v for k, v in questions2.items() if
-                                     k in df1.columns}
-        filtered_list_name_labels = filtered_list_name_labels.values()
-
-        # Append the first two columns
-        questions_lists = (['start', 'end', 'Latitude', 'Longitude'] +
-                           list(
-                               filtered_list_name_labels))
-
-        # Transpose the data with questions in row
-        df_transposed = df1.transpose()
-
-        # Get the total number of columns in df_transposed
-        total_columns = df_transposed.shape[1]
-
-        # Create the "Respondent number" vector starting from 1 to
-        # total number of columns
-        respondent_number = [f"Respondent {res + 1}" for res in
-                             range(total_columns)]
-
-        df_transposed.columns = respondent_number
-
-        # Add the questions
-        df_transposed.insert(0, 'Question',
-                             questions_lists)
-
-        # Reset the row index of df_transposed without
-        # creating an index column
-        df_transposed.reset_index(drop=True, inplace=True)
-
-        # Get verification number
-        ver_no_select = entry.get(
-            'consented_grp/section_b/verification_no')
-
-        # Access the 'verification_no' dictionary and get the label for
-        # the specified ver_no_select
-        base_ver_no = choice_lists[
-            'verification_no'].get(ver_no_select,
-                                   {}).get('label', f"df_{index + 1}")
-
-        # Check if ver_no already exists in df_lists,
-        # add a suffix if it does
-        ver_no = base_ver_no
-        suffix = 1
-        while ver_no in df_lists:
-            ver_no = f"{base_ver_no}_{suffix}"
+
+    if commits and st.sidebar.button("Discard Changes",
+                                     key=f"{key}_discard"):
+        edit_log.clear()
+        st.rerun()
+
+    return reviewed_df if commits else None
+
+
+# Counters and sizes of the process-wide caches, by cache
+def cache_stats():
+    return {cache.name: cache.stats()
+            for cache in (_data_cache, _schema_cache, _excel_files)}
+
+
+# Columns of the diagnostics table, in display order
+SPAN_COLUMNS = ['span', 'seconds', 'asset', 'rows', 'cols', 'bytes',
+                'cache', 'error']
+
+
+# Sidebar panel with the spans of the current run (see kobo_trace): time
+# spent per stage, data fetched from Kobo and cache hits/misses
+def diagnostics_panel(spans):
+    import streamlit as st
+
+    records = [record.to_dict() for record in spans]
+    requests = [r for r in records if r['span'] == 'kobo_request']
+    lookups = [r.get('cache') for r in records if r.get('cache')]
+    top_level = [r['seconds'] for r in records if r['parent'] is None]
+
+    st.sidebar.markdown("### Diagnostics")
+    st.sidebar.caption(
+        f"{sum(top_level):.2f}s traced, {len(requests)} Kobo requests "
+        f"({sum(r.get('bytes') or 0 for r in requests) / 1e6:.2f} MB), "
+        f"cache {lookups.count('hit')} hits / {lookups.count('miss')} misses"
+        f" / {lookups.count('wait')} waits")
+    if records:
+        table = pd.DataFrame(records)
+        table = table[[c for c in SPAN_COLUMNS if c in table.columns]]
+        st.sidebar.dataframe(table, hide_index=True,
+                             use_container_width=True)
+
+    # Shared caches since the server started
+    stats = cache_stats()
+    st.sidebar.caption(
+        f"Shared data cache: {stats['data']['entries']} entries, "
+        f"{stats['data']['size'] / 2 ** 20:.0f} of {DATA_CACHE_MB} MB")
+    st.sidebar.dataframe(
+        pd.DataFrame(stats).T[['hits', 'misses', 'coalesced']]
+        .rename_axis('cache').reset_index(),
+        hide_index=True, use_container_width=True)
+
+
+# Build the transposed frame (questions in rows, respondents in columns) of
+# one FGD submission
+def build_verification_frame(entry, schema):
+    # Filter the data based on dictionary
+    filtered_dict = {key: value for key, value in entry.items()
+                     if isinstance(value, list) and
+                     any(isinstance(i, dict) for i in value)}
+
+    # Initialize an empty list to store each DataFrame created in the loop
+    df_list = []
+
+    # Loop through and create the DataFrame
+    for i in filtered_dict:
+        # Create DataFrame by normalizing JSON data
+        df2 = pd.json_normalize(filtered_dict[i])
+
+        # Drop columns that end with '_index'
+        df2 = df2[df2.columns.drop(list(df2.filter(regex='_index$')))]
+
+        # Append df2 to the list
+        df_list.append(df2)
+    df1 = pd.concat(df_list, axis=1)
+
+    # Get the number of rows of the DataFrame
+    nrows = df1.shape[0]
+
+    # Get and append the latitudes and longitudes in the df
+    precise_location = entry.get(
+        'consented_grp/section_b/precise_location')
+    location_parts = split_geopoints([precise_location]).iloc[0]
+    lat = [location_parts[0] for _ in range(nrows)]
+    lon = [location_parts[1] for _ in range(nrows)]
+
+    # Add the latitudes and longitudes
+    df1.insert(0, 'Longitude', lon)
+    df1.insert(0, 'Latitude', lat)
+
+    # Get start and end dates
+    start_dates = [entry.get('start') for _ in range(nrows)]
+    end_dates = [entry.get('end') for _ in range(nrows)]
+
+    # Add the start and end dates
+    df1.insert(0, 'End', end_dates)
+    df1.insert(0, 'Start', start_dates)
+
+    # Clean the columns
+    cols = [col for col in df1.columns if
+            col.startswith('consented_grp')]
+
+    # Extract the third value from each string if it has at least three parts
+    fourth_values = [item.split('/')[-1] for item in cols]
+
+    columns_cleaned = ['start', 'end', 'Latitude', 'Longitude']
+    for i in fourth_values:
+        columns_cleaned.append(i)
+
+    # Rename columns for df
+    df1.columns = columns_cleaned
+
+    # Iterate over the list_name_keys to modify the appropriate columns in df
+    for col, list_name in schema.column_list_names.items():
+        if col in df1.columns and list_name in schema.choice_labels:
+            # Replace the numeric values in the column with the
+            # corresponding labels from choice_lists
+            labels = schema.choice_labels[list_name]
+            df1[col] = df1[col].astype(str).map(
+                lambda x: labels.get(x, x))
+
+    filtered_list_name_labels = {k: v for k, v in
+                                 schema.column_labels.items() if
+                                 k in df1.columns}
+    filtered_list_name_labels = filtered_list_name_labels.values()
+
+    # Append the first two columns
+    questions_lists = (['start', 'end', 'Latitude', 'Longitude'] +
+                       list(
+                           filtered_list_name_labels))
+
+    # Transpose the data with questions in row
+    df_transposed = df1.transpose()
+
+    # Get the total number of columns in df_transposed
+    total_columns = df_transposed.shape[1]
+
+    # Create the "Respondent number" vector starting from 1 to
+    # total number of columns
+    respondent_number = [f"Respondent {res + 1}" for res in
+                         range(total_columns)]
+
+    df_transposed.columns = respondent_number
+
+    # Add the questions
+    df_transposed.insert(0, 'Question',
+                         questions_lists)
+
+    # Reset the row index of df_transposed without
+    # creating an index column
+    df_transposed.reset_index(drop=True, inplace=True)
+
+    return df_transposed
+
+
+# Submission field holding the location of an FGD
+LOCATION_FIELD = 'consented_grp/section_b/precise_location'
+
+# Rows build_verification_frame puts above the questions
+VERIFICATION_META = ['start', 'end', 'Latitude', 'Longitude']
+
+
+# The repeat groups of many FGD submissions flattened in a single pass into
+# a long table with one row per answer:
+#   submissions: one row per submission (id, verification, start, end,
+#       latitude and longitude as floats, NaN without a location, and
+#       number of respondents)
+#   answers: submission (position), respondent (number), position (of the
+#       question in the submission), question (code) and answer, with the
+#       answers of select questions labeled in bulk per choice list
+# frame(i) gives the frame build_verification_frame makes for submission i
+# by scattering its slice of the table into a question x respondent block.
+# Submissions build_verification_frame treats specially (no repeat group,
+# nested records, questions it cannot label) are left to it. Locations are
+# parsed for all submissions at once once the pass is done.
+class RepeatGroupTable:
+    def __init__(self, entries, schema):
+        self.schema = schema
+        self._fallbacks = {}
+        self._layouts = []
+        layouts = {}
+        submissions = []
+        locations = []
+        rows = ([], [], [], [], [])
+        sub_positions, respondents, positions, keys, values = rows
+
+        for index, entry in enumerate(entries):
+            first_row = len(values)
+            columns = []
+            n_respondents = 0
+            flat = True
+            for value in entry.values():
+                if not (isinstance(value, list) and
+                        any(isinstance(item, dict) for item in value)):
+                    continue
+                group = {}
+                offset = len(columns)
+                for number, item in enumerate(value, 1):
+                    if not isinstance(item, dict):
+                        flat = False
+                        break
+                    for key, answer in item.items():
+                        if key.endswith('_index'):
+                            continue
+                        if (isinstance(answer, dict) or
+                                not key.startswith('consented_grp')):
+                            flat = False
+                        position = group.get(key)
+                        if position is None:
+                            position = group[key] = offset + len(group)
+                        sub_positions.append(index)
+                        respondents.append(number)
+                        positions.append(position)
+                        keys.append(key)
+                        values.append(answer)
+                n_respondents = max(n_respondents, len(value))
+                columns.extend(group)
+
+            layout = None
+            if flat and columns:
+                codes = tuple(key.split('/')[-1] for key in columns)
+                layout = layouts.get(codes)
+                if layout is None:
+                    layout = layouts[codes] = self._layout(codes)
+            if layout is None:
+                # Left to build_verification_frame
+                for row_values in rows:
+                    del row_values[first_row:]
+                self._fallbacks[index] = entry
+            self._layouts.append(layout)
+            locations.append(entry.get(LOCATION_FIELD))
+            submissions.append((entry.get('_id'),
+                                entry.get(VERIFICATION_FIELD),
+                                entry.get('start'), entry.get('end'),
+                                n_respondents))
+
+        self.submissions = pd.DataFrame(
+            submissions, columns=['id', 'verification', 'start', 'end',
+                                  'respondents'])
+        # Coordinates as floats, and as the text the frames show
+        self._location_parts = split_geopoints(locations)
+        coordinates = _coordinates(self._location_parts[0],
+                                   self._location_parts[1])
+        self.submissions.insert(4, 'latitude', coordinates['Latitude'])
+        self.submissions.insert(5, 'longitude', coordinates['Longitude'])
+        code_of = {key: key.split('/')[-1] for key in set(keys)}
+        self.answers = pd.DataFrame({
+            'submission': np.array(sub_positions, dtype=np.int64),
+            'respondent': np.array(respondents, dtype=np.int64),
+            'position': np.array(positions, dtype=np.int64),
+            'question': [code_of[key] for key in keys],
+            'answer': pd.Series(values, dtype=object),
+        })
+        self._label_answers()
+
+    # Question labels and select question rows of a submission whose
+    # repeat groups hold the questions `codes` (None if
+    # build_verification_frame would not label them one to one)
+    def _layout(self, codes):
+        present = set(codes)
+        labels = [label for code, label in self.schema.column_labels.items()
+                  if code in present]
+        if len(labels) != len(codes):
+            return None
+        selects = [row for row, code in enumerate(codes)
+                   if self.schema.column_list_names.get(code)
+                   in self.schema.choice_labels]
+        return (np.array(VERIFICATION_META + labels, dtype=object),
+                np.array(selects, dtype=np.int64) + len(VERIFICATION_META))
+
+    # Label the answers of select questions, one choice list at a time.
+    # Answers are labeled as text, like build_verification_frame does.
+    def _label_answers(self):
+        codes_by_list = {}
+        for code, list_name in self.schema.column_list_names.items():
+            if list_name in self.schema.choice_labels:
+                codes_by_list.setdefault(list_name, []).append(code)
+        answers = self.answers['answer'].to_numpy(copy=True)
+        for list_name, codes in codes_by_list.items():
+            mask = self.answers['question'].isin(codes).to_numpy()
+            if not mask.any():
+                continue
+            text = pd.Series(answers[mask], dtype=object).astype(str)
+            labeled = text.map(self.schema.choice_labels[list_name])
+            answers[mask] = labeled.where(labeled.notna(), text).to_numpy()
+        self.answers['answer'] = answers
+
+    def __len__(self):
+        return len(self.submissions)
+
+    # Frame of submission `index`: questions in rows, respondents in columns
+    def frame(self, index):
+        if index in self._fallbacks:
+            return build_verification_frame(self._fallbacks[index],
+                                            self.schema)
+        labels, selects = self._layouts[index]
+        arrays = self._arrays()
+        n_respondents = int(arrays['respondents'][index])
+
+        # Slice of the answers of this submission
+        first, last = arrays['bounds'][index:index + 2]
+        rows = arrays['position'][first:last] + len(VERIFICATION_META)
+        columns = arrays['respondent'][first:last]
+
+        block = np.empty((len(labels), n_respondents + 1), dtype=object)
+        block[:, 0] = labels
+        block[:len(VERIFICATION_META), 1:] = arrays['meta'][index][:, None]
+        block[len(VERIFICATION_META):, 1:] = np.nan
+        # Select answers missing for a respondent read 'nan', as when
+        # labeled as text
+        block[selects, 1:] = 'nan'
+        block[rows, columns] = arrays['answer'][first:last]
+        return pd.DataFrame(
+            block, columns=['Question'] + [f"Respondent {number}"
+                                           for number in
+                                           range(1, n_respondents + 1)],
+            dtype=object)
+
+    # Name of the verification of each submission, as generate_dataframes
+    # names its frames. Pass the VerificationNames of the tables before
+    # this one when a project is flattened in chunks.
+    def verification_names(self, names=None):
+        if names is None:
+            names = VerificationNames(self.schema.choice_lists)
+        return [names.add(ver_no_select)
+                for ver_no_select in self.submissions['verification']]
+
+    # Columns of the table as arrays, for slicing frames out of it cheaply
+    def _arrays(self):
+        if getattr(self, '_array_cache', None) is None:
+            submission = self.answers['submission'].to_numpy()
+            self._array_cache = {
+                'bounds': np.searchsorted(submission,
+                                          np.arange(len(self) + 1)),
+                'position': self.answers['position'].to_numpy(),
+                'respondent': self.answers['respondent'].to_numpy(),
+                'answer': self.answers['answer'].to_numpy(),
+                'respondents': self.submissions['respondents'].to_numpy(),
+                'meta': np.column_stack([
+                    self.submissions[['start', 'end']].to_numpy(
+                        dtype=object),
+                    self._location_parts.to_numpy(dtype=object)]),
+            }
+        return self._array_cache
+
+
+# Name of a verification: the label of its verification number (or
+# df_<position>), with a _1, _2, ... suffix if the name is already taken.
+# `suffixes` (a dict kept across calls with the same `taken`) remembers the
+# last suffix given to each name, so numbering many submissions of one
+# verification does not try every taken suffix again.
+def unique_verification_name(ver_no_select, index, choice_lists, taken,
+                             suffixes=None):
+    # Access the 'verification_no' dictionary and get the label for
+    # the specified ver_no_select
+    base_ver_no = choice_lists[
+        'verification_no'].get(ver_no_select,
+                               {}).get('label', f"df_{index + 1}")
+
+    # Check if ver_no already exists, add a suffix if it does
+    ver_no = base_ver_no
+    if ver_no in taken:
+        suffix = 1 if suffixes is None else suffixes.get(base_ver_no, 1)
+        while f"{base_ver_no}_{suffix}" in taken:
             suffix += 1
+        ver_no = f"{base_ver_no}_{suffix}"
+        if suffixes is not None:
+            suffixes[base_ver_no] = suffix
+    return ver_no
+
+
+# Names of the verifications of a project's submissions, given one at a
+# time in submission order (see unique_verification_name); the taken names
+# and suffixes are kept across calls
+class VerificationNames:
+    def __init__(self, choice_lists):
+        self.choice_lists = choice_lists
+        self.taken = set()
+        self.suffixes = {}
+
+    def add(self, ver_no_select):
+        name = unique_verification_name(ver_no_select, len(self),
+                                        self.choice_lists, self.taken,
+                                        self.suffixes)
+        self.taken.add(name)
+        return name
+
+    # Number of names given so far, i.e. of submissions
+    def __len__(self):
+        return len(self.taken)
+
+
+# The FGD submissions of an asset flattened into one RepeatGroupTable per
+# FGD_CHUNK_SIZE submissions, as the pages arrive, so only one chunk is
+# held at a time. With more than one worker (default FGD_WORKERS) the
+# chunks are flattened on a pool, at most `workers` chunks ahead of the
+# one consumed. Name the verifications of the tables with one
+# VerificationNames, in order.
+def iter_repeat_group_tables(user_id, workers=None, kobo=None):
+    if workers is None:
+        workers = FGD_WORKERS
+    schema, pages = fetch_schema_and_pages(user_id, kobo=kobo)
+    entries = (entry for page in pages for entry in page)
+    chunks = iter(lambda: list(itertools.islice(entries, FGD_CHUNK_SIZE)),
+                  [])
+    if workers > 1:
+        tables = _flatten_chunks_parallel(chunks, schema, workers)
+    else:
+        tables = (RepeatGroupTable(chunk, schema) for chunk in chunks)
+    while True:
+        with span('flatten_repeat_groups', asset=user_id,
+                  workers=workers) as record:
+            table = next(tables, None)
+            if table is None:
+                return
+            record.set(rows=len(table.answers), submissions=len(table))
+        yield table
+
+
+# RepeatGroupTable of each chunk, in order, flattened on a pool of
+# `workers` with no more than `workers` chunks waiting to be consumed
+def _flatten_chunks_parallel(chunks, schema, workers):
+    if FGD_EXECUTOR == 'thread':
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    with executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(RepeatGroupTable, chunk, schema))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+# Repeat groups of all the FGD submissions of an asset, flattened into a
+# RepeatGroupTable as the pages arrive
+def flatten_repeat_groups(user_id, kobo=None):
+    schema, pages = fetch_schema_and_pages(user_id, kobo=kobo)
+    with span('flatten_repeat_groups', asset=user_id) as record:
+        table = RepeatGroupTable(
+            (entry for page in pages for entry in page), schema)
+        record.set(rows=len(table.answers), submissions=len(table))
+    return table
+
+
+def generate_dataframes(user_id, workers=None, kobo=None):
+    with span('generate_dataframes', asset=user_id) as record:
+        if workers is None:
+            workers = FGD_WORKERS
+        if workers > 1:
+            tables = iter_repeat_group_tables(user_id, workers, kobo=kobo)
+        else:
+            tables = [flatten_repeat_groups(user_id, kobo=kobo)]
+
+        # Initialize an empty dictionary to store each df created with
+        # dynamic names
+        df_lists = {}
+        names = None
+
+        # Name the frame of each submission after its verification
+        for table in tables:
+            if names is None:
+                names = VerificationNames(table.schema.choice_lists)
+            for index, ver_no in enumerate(table.verification_names(names)):
+                df_lists[ver_no] = table.frame(index)
+
+        record.set(frames=len(df_lists), workers=workers)
+        return df_lists
+
+
+# Cheap first stage of the FGD flow: the verification names, in the same
+# order and with the same suffixes as generate_dataframes, mapped to the
+# `_id` of the submission each one comes from. No frame is built.
+def index_verifications(user_id, kobo=None):
+    with span('index_verifications', asset=user_id) as record:
+        schema, pages = fetch_schema_and_pages(user_id, kobo=kobo)
+        entries = (entry for page in pages for entry in page)
+
+        verifications = {}
+        suffixes = {}
+        for index, entry in enumerate(entries):
+            ver_no = unique_verification_name(entry.get(VERIFICATION_FIELD),
+                                              index, schema.choice_lists,
+                                              verifications, suffixes)
+            verifications[ver_no] = entry['_id']
+        record.set(rows=len(verifications))
+        return verifications
+
+
+# Float coordinates of all the FGD submissions of an asset (one row per
+# submission, see parse_geopoints), parsed in bulk without flattening the
+# repeat groups
+def get_fgd_locations(user_id, kobo=None):
+    with span('fgd_locations', asset=user_id) as record:
+        locations = [entry.get(LOCATION_FIELD)
+                     for page in iter_submission_pages(user_id, kobo=kobo)
+                     for entry in page]
+        points = parse_geopoints(locations)
+        record.set(rows=len(points))
+        return points
+
+
+# A single submission, from the local store when possible, otherwise
+# queried from Kobo by its `_id`
+def get_submission(user_uid, submission_id, kobo=None):
+    kobo = kobo or get_kobo()
+    if INCREMENTAL_SYNC:
+        entry = SubmissionStore(user_uid).get(submission_id)
+        if entry is not None:
+            return entry
+    query = json.dumps({'_id': submission_id})
+    results = kobo.get_data(user_uid, query=query, limit=1)['results']
+    return results[0] if results else None
+
+
+# Second stage of the FGD flow: build the frame of one verification only
+def get_verification_frame(user_id, ver_no, verifications=None, kobo=None):
+    if verifications is None:
+        verifications = index_verifications(user_id, kobo=kobo)
+    with span('build_verification', asset=user_id,
+              verification=ver_no) as record:
+        schema = get_asset_schema(user_id, kobo=kobo)
+        entry = get_submission(user_id, verifications[ver_no], kobo=kobo)
+        df = RepeatGroupTable([entry], schema).frame(0)
+        record.set(rows=df.shape[0], cols=df.shape[1])
+        return df
+
+
+# Frame store of the current version of an asset (None when disabled)
+def get_frame_store(user_uid):
+    if not FRAME_STORE:
+        return None
+    return FrameStore(user_uid, get_freshness_token(user_uid))
+
+
+# Labeled frame `name` of an asset from the frame store, built with `build`
+# and saved on a miss. Frames pyarrow cannot store are only returned.
+def load_labeled_frame(user_uid, name, build):
+    store = get_frame_store(user_uid)
+    if store is None:
+        return build()
+    with span('frame_store', asset=user_uid, frame=name) as record:
+        df = store.load(name)
+        record.set(cache='hit' if df is not None else 'miss')
+        if df is None:
+            df = build()
+            if df is not None:
+                try:
+                    store.save(name, df)
+                except (pa.ArrowException, TypeError, ValueError):
+                    pass
+        if df is not None:
+            record.set(rows=df.shape[0], cols=df.shape[1])
+        return df
+
 
-        # Update the df dictionary with dynamic names
-        df_lists[ver_no] = df_transposed
+# FGD frames are stored with respondents in rows, which gives every
+# question its own consistently typed column
+def _respondent_rows(df):
+    return df.set_index('Question').T
 
-    return df_lists
 
+def _question_rows(df):
+    return df.T.rename_axis('Question').reset_index()
 
 
-if __name__ == "__main__":
-    # Test the functions
-    user_id = 'agnYS6ing2xugLZansqRDj'
-    # df = get_kii_data(user_uid=user_id, kobo=kobo)
-    # print(df.head())
-    df = generate_dataframes(user_id)
-    df.keys()
-    pass
+def _verification_frame_name(ver_no):
+    return f'fgd/{ver_no}'
+
+
+# Verification index of an FGD asset, through the frame store
+def load_verification_index(user_id):
+    def build():
+        verifications = index_verifications(user_id)
+        return pd.DataFrame({'name': list(verifications),
+                             'id': list(verifications.values())})
+    index = load_labeled_frame(user_id, 'fgd_index', build)
+    return dict(zip(index['name'], index['id'].tolist()))
+
+
+# Frame of one FGD verification, through the frame store
+def load_verification_frame(user_id, ver_no, verifications=None):
+    def build():
+        return _respondent_rows(get_verification_frame(
+            user_id, ver_no, verifications=verifications))
+    return _question_rows(load_labeled_frame(
+        user_id, _verification_frame_name(ver_no), build))
+
+
+# Cached versions of the KII and FGD loaders. Results are keyed by the asset
+# uid and its freshness token, so repeated reruns of the app reuse the
+# processed frames until the project changes on Kobo. Behind this in-process
+# cache, labeled frames are also kept in the frame store. Callers must treat
+# the returned frames as read-only since they are shared between reruns.
+# Filtered KII selections (a `query` or `fields`) are only kept in this
+# cache, the frame store holds the full data.
+def get_cached_kii_data(user_uid, query=None, fields=None):
+    key = ('kii', user_uid, get_freshness_token(user_uid), query, fields)
+
+    def load():
+        if query or fields:
+            df = get_kii_data(user_uid, query=query, fields=fields)
+        else:
+            df = load_labeled_frame(user_uid, 'kii',
+                                    lambda: get_kii_data(user_uid))
+        if not COMPACT_DTYPES or df is None:
+            return df
+        return compact_cached_frame(
+            df, (user_uid, kii_selection_name(query, fields)),
+            get_asset_schema(user_uid).question_choice_labels)
+    return _data_cache.get_or_compute(key, load)
+
+
+# KII data of an asset as the app shows it: the frame saved in the frame
+# store, read in parts (see StoredFrame), when the whole data is saved there,
+# otherwise the cached frame (see get_cached_kii_data). The handle is cached
+# so reruns get the same object.
+def get_kii_frame(user_uid, query=None, fields=None):
+    if not (query or fields):
+        store = get_frame_store(user_uid)
+        if store is not None and 'kii' in store:
+            key = ('kii_stored', user_uid, get_freshness_token(user_uid))
+            stored = _data_cache.get_or_compute(key,
+                                                lambda: store.open('kii'))
+            if stored is not None:
+                return stored
+    return get_cached_kii_data(user_uid, query=query, fields=fields)
+
+
+# Cached two-stage FGD loaders: the verification index, then the frame of
+# the selected verification only
+def get_cached_verification_index(user_id):
+    key = ('fgd_index', user_id, get_freshness_token(user_id))
+    return _data_cache.get_or_compute(
+        key, lambda: load_verification_index(user_id))
+
+
+def get_cached_verification_frame(user_id, ver_no):
+    token = get_freshness_token(user_id)
+    key = ('fgd_frame', user_id, token, ver_no)
+    return _data_cache.get_or_compute(
+        key, lambda: compact_cached_frame(
+            load_verification_frame(
+                user_id, ver_no,
+                verifications=get_cached_verification_index(user_id)),
+            (user_id, ver_no)))
+
+
+# Coordinates of the submissions of a project for the map: the KII
+# selection loaded by the app, or all the FGD submissions
+def get_cached_locations(user_uid, kind, query=None, fields=None):
+    if kind == 'kii':
+        df = get_cached_kii_data(user_uid, query=query, fields=fields)
+        if df is None:
+            return _coordinates([], [])
+        return df[list(COORDINATE_COLUMNS)]
+    key = ('fgd_locations', user_uid, get_freshness_token(user_uid))
+    return _data_cache.get_or_compute(
+        key, lambda: get_fgd_locations(user_uid))
+
+
+# Download every submission of an asset again and drop the frames built
+# from the old copy, cached or saved. Needed to see answers corrected on
+# Kobo right away: edits do not change the freshness token the caches are
+# keyed by, so they are otherwise picked up when the cached frames expire.
+def reload_project(user_uid, kobo=None):
+    with span('reload_project', asset=user_uid):
+        if INCREMENTAL_SYNC:
+            sync_submissions(user_uid, kobo=kobo, full_refresh=True)
+        FrameStore(user_uid, None).clear()
+        clear_cache()
+
+
+# Drop all cached assets and frames, e.g. to force a reload from Kobo
+def clear_cache():
+    _assets_cache.clear()
+    _data_cache.clear()
+    _memory_reports.clear()
+    _excel_files.clear()
@@ -0,0 +1,117 @@
+import threading
+
+from cachetools import TTLCache
+
+from kobo_trace import span
+
+
+# Value of a computation in progress, shared with the callers waiting for it
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+# Time-to-live, size-bounded cache for processed Kobo results, shared by all
+# sessions of the process. Entries are keyed by the caller (e.g. asset uid
+# plus a freshness token) and are evicted least-recently-used once `maxsize`
+# is reached or after `ttl` seconds, whichever comes first. With
+# `getsizeof` (e.g. len for bytes) `maxsize` bounds the total size of the
+# entries instead of their number.
+#
+# Misses are single-flight: while a value is computed, other callers asking
+# for the same key wait for it instead of computing it again. Hits, misses
+# and such coalesced waits are counted (see stats). Lookups of a named
+# cache are traced as 'cache' spans with a hit/miss/wait field.
+class ResultCache:
+    def __init__(self, maxsize=16, ttl=3600, name=None, getsizeof=None):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl, getsizeof=getsizeof)
+        self._lock = threading.RLock()
+        self._flights = {}
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._cache.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            try:
+                self._cache[key] = value
+            except ValueError:
+                # Larger than the whole cache, not kept
+                pass
+
+    # Return the cached value for key, computing and storing it on a miss
+    def get_or_compute(self, key, compute):
+        if self.name is None:
+            return self._get_or_compute(key, compute)
+        entry = ('/'.join(str(part) for part in key[:2])
+                 if isinstance(key, tuple) else str(key))
+        with span('cache', cache_name=self.name, entry=entry) as record:
+            return self._get_or_compute(key, compute, record)
+
+    def _get_or_compute(self, key, compute, record=None):
+        with self._lock:
+            value = self._cache.get(key, _MISSING)
+            if value is not _MISSING:
+                self.hits += 1
+                outcome = 'hit'
+            elif key in self._flights:
+                flight = self._flights[key]
+                self.coalesced += 1
+                outcome = 'wait'
+            else:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+                outcome = 'miss'
+        if record is not None:
+            record.set(cache=outcome)
+
+        if outcome == 'hit':
+            return value
+        if outcome == 'wait':
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+            self.set(key, flight.value)
+            return flight.value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    # Counters and current size of the cache
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._cache),
+                    'size': self._cache.currsize,
+                    'maxsize': self._cache.maxsize,
+                    'hits': self.hits, 'misses': self.misses,
+                    'coalesced': self.coalesced}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._cache
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
+
+
+_MISSING = object()
@@ -0,0 +1,387 @@
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import kobo_access as ka
+from kobo_cache import ResultCache
+from kobo_trace import span
+
+# Exports of whole projects written to files in chunks, so neither the
+# labeled data nor the file is ever held in memory at once:
+#   csv / parquet: the labeled KII data (one row per submission) or the FGD
+#       answers as a long table (one row per answer)
+#   xlsx: for FGD projects, one workbook with a sheet per verification,
+#       written in xlsxwriter's constant memory mode
+# Files are written to EXPORT_DIR and downloads are served from there.
+
+# Directory of the export files, and seconds they are kept after being
+# written (older files are removed whenever a new export is written)
+EXPORT_DIR = os.environ.get('KOBO_EXPORT_DIR') or os.path.join(
+    tempfile.gettempdir(), 'kobo_exports')
+EXPORT_TTL = int(os.environ.get('KOBO_EXPORT_TTL', str(24 * 3600)))
+
+# Rows written per chunk (one row group per chunk in Parquet files)
+EXPORT_CHUNK_ROWS = 10000
+
+# Export format -> (file extension, MIME type, label)
+EXPORT_FORMATS = {
+    'csv': ('csv', 'text/csv', 'CSV'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet', 'Parquet'),
+    'xlsx': ('xlsx', 'application/vnd.openxmlformats-officedocument'
+                     '.spreadsheetml.sheet', 'Excel'),
+}
+
+# Formats offered per kind of project
+KII_FORMATS = ('csv', 'parquet')
+FGD_FORMATS = ('xlsx', 'csv', 'parquet')
+
+# Columns of the long FGD export
+FGD_EXPORT_COLUMNS = ['submission_id', 'verification', 'start', 'end',
+                      'Latitude', 'Longitude', 'respondent', 'question',
+                      'answer']
+
+_exports = ResultCache(maxsize=64, ttl=EXPORT_TTL, name='export')
+
+
+# Columns of a KII export: the metadata label_kii_columns puts first, then
+# the question labels in form order, restricted to the questions of the
+# `fields` projection if any (see kobo_access.build_submission_fields)
+def kii_export_columns(schema, fields=None):
+    paths = set(json.loads(fields)) if fields else None
+    columns = ['start', 'end', *ka.COORDINATE_COLUMNS]
+    for path, question in schema.question_paths.items():
+        label = question['label']
+        if paths is not None and path not in paths:
+            continue
+        if label.startswith("Time difference in") or label in columns:
+            continue
+        columns.append(label)
+    return columns
+
+
+# Labeled KII data page by page, every chunk with the columns of
+# kii_export_columns. Rows are ordered by submission time like in the app.
+# Answers to questions no longer in the deployed form are left out, since
+# the columns are fixed up front.
+def iter_kii_chunks(user_uid, kobo=None, query=None, fields=None):
+    schema, pages = ka.fetch_schema_and_pages(user_uid, kobo=kobo,
+                                              query=query, fields=fields,
+                                              by_time=True)
+    columns = kii_export_columns(schema, fields)
+    for page in pages:
+        with span('label_kii_page', rows=len(page)):
+            chunk = ka.label_kii_columns(page, schema, kobo=kobo)
+        yield chunk.reindex(columns=columns)
+
+
+# The FGD answers of a RepeatGroupTable as long frames of about `rows` rows
+# with the FGD_EXPORT_COLUMNS, followed by the answers of the submissions
+# the table leaves to build_verification_frame. `names` (a
+# VerificationNames) carries the verification names over from the tables
+# before this one.
+def iter_fgd_chunks(table, rows=None, names=None):
+    rows = rows or EXPORT_CHUNK_ROWS
+    names = np.array(table.verification_names(names), dtype=object)
+    submissions = table.submissions
+    meta = {
+        'submission_id': submissions['id'].to_numpy(),
+        'verification': names,
+        'start': submissions['start'].to_numpy(),
+        'end': submissions['end'].to_numpy(),
+        'Latitude': submissions['latitude'].to_numpy(),
+        'Longitude': submissions['longitude'].to_numpy(),
+    }
+    labels = table.schema.column_labels
+    answers = table.answers
+    for first in range(0, len(answers), rows):
+        part = answers.iloc[first:first + rows]
+        positions = part['submission'].to_numpy()
+        chunk = {name: values[positions] for name, values in meta.items()}
+        chunk['respondent'] = part['respondent'].to_numpy()
+        chunk['question'] = part['question'].map(
+            lambda code: labels.get(code, code)).to_numpy()
+        chunk['answer'] = part['answer'].to_numpy()
+        yield pd.DataFrame(chunk, columns=FGD_EXPORT_COLUMNS)
+
+    for index in sorted(table._fallbacks):
+        yield _fallback_rows(table.frame(index), meta['submission_id'][index],
+                             names[index])
+
+
+# Long rows of a frame from build_verification_frame: the metadata rows
+# give the columns of the same name, missing answers are dropped
+def _fallback_rows(df, submission_id, name):
+    n_meta = len(ka.VERIFICATION_META)
+    meta = dict(zip(ka.VERIFICATION_META,
+                    df.iloc[:n_meta, 1] if df.shape[1] > 1
+                    else [None] * n_meta))
+    long = df.iloc[n_meta:].melt(id_vars=df.columns[0],
+                                 var_name='respondent', value_name='answer')
+    long = long[long['answer'].notna()]
+    numbers = {column: number
+               for number, column in enumerate(df.columns[1:], 1)}
+    return pd.DataFrame({
+        'submission_id': submission_id,
+        'verification': name,
+        'start': meta['start'],
+        'end': meta['end'],
+        'Latitude': pd.to_numeric(meta['Latitude'], errors='coerce'),
+        'Longitude': pd.to_numeric(meta['Longitude'], errors='coerce'),
+        'respondent': long['respondent'].map(numbers).to_numpy(),
+        'question': long.iloc[:, 0].to_numpy(),
+        'answer': long['answer'].to_numpy(),
+    }, columns=FGD_EXPORT_COLUMNS)
+
+
+# Regroup `chunks` into frames of at least `rows` rows (but the last one),
+# so pages of any size are written in few, large chunks
+def rechunk(chunks, rows=None):
+    rows = rows or EXPORT_CHUNK_ROWS
+    buffer = []
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= rows:
+            yield pd.concat(buffer, ignore_index=True)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield pd.concat(buffer, ignore_index=True)
+
+
+# Parquet schema of export columns: numbers for the coordinates and the
+# respondent numbers, text for everything else
+def export_schema(columns):
+    types = {'Latitude': pa.float64(), 'Longitude': pa.float64(),
+             'respondent': pa.int64(), 'submission_id': pa.int64()}
+    return pa.schema([(column, types.get(column, pa.string()))
+                      for column in columns])
+
+
+def _arrow_table(chunk, schema):
+    arrays = []
+    for field in schema:
+        col = chunk[field.name]
+        if pa.types.is_string(field.type):
+            # Answers of any type are written as text
+            col = col.astype('string')
+        else:
+            col = pd.to_numeric(col, errors='coerce')
+        arrays.append(pa.array(col, type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+# Write `chunks` (frames with the same columns) to a CSV file one at a time.
+# Returns the number of rows written.
+def write_csv(chunks, path, columns):
+    rows = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        pd.DataFrame(columns=columns).to_csv(f, index=False)
+        for chunk in chunks:
+            chunk.to_csv(f, header=False, index=False)
+            rows += len(chunk)
+    return rows
+
+
+# Write `chunks` to a Parquet file, one row group per chunk. Returns the
+# number of rows written.
+def write_parquet(chunks, path, columns):
+    import pyarrow.parquet as pq
+
+    schema = export_schema(columns)
+    rows = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(_arrow_table(chunk, schema))
+            rows += len(chunk)
+    return rows
+
+
+# Write the workbook of all the verifications of RepeatGroupTables (the
+# chunks of one project, see iter_repeat_group_tables), one sheet per
+# verification laid out like the app's downloads. Frames are built one at a
+# time and written in constant memory mode, so memory stays flat however
+# many verifications the project has. `names` is the VerificationNames
+# the verifications are named with. Returns the number of sheets.
+def write_fgd_workbook(tables, path, names):
+    frames = ((name, ka.without_column_names(table.frame(index)))
+              for table in tables
+              for index, name in enumerate(table.verification_names(names)))
+    ka.create_excel_workbook(frames, constant_memory=True, output=path)
+    return len(names)
+
+
+# The FGD answers of RepeatGroupTables (the chunks of one project) as long
+# frames of about `rows` rows, see iter_fgd_chunks
+def iter_project_fgd_chunks(tables, names, rows=None):
+    for table in tables:
+        yield from iter_fgd_chunks(table, rows, names)
+
+
+# Write the export of a project ('kii' or 'fgd') in `file_format` to
+# `path`. KII workbooks are laid out like the app's download (questions in
+# rows), which Excel limits to 16383 submissions. Returns the number of
+# submissions exported, 0 when the project has no data.
+def write_project_export(user_uid, kind, path, file_format, name=None,
+                         kobo=None, query=None, fields=None,
+                         constant_memory=False):
+    with span('export', asset=user_uid, kind=kind,
+              format=file_format) as record:
+        if kind == 'kii' and file_format == 'xlsx':
+            df = ka.get_kii_data(user_uid, kobo=kobo, query=query,
+                                 fields=fields)
+            submissions = rows = 0 if df is None else len(df)
+            if submissions:
+                # Questions in rows, respondents in columns
+                ka.create_excel_workbook(
+                    {name or user_uid:
+                     ka.without_column_names(df.T.reset_index())},
+                    constant_memory=constant_memory, output=path)
+        elif kind == 'kii':
+            schema = ka.get_asset_schema(user_uid, kobo=kobo)
+            columns = kii_export_columns(schema, fields)
+            chunks = rechunk(iter_kii_chunks(user_uid, kobo=kobo,
+                                             query=query, fields=fields))
+            submissions = rows = _write_chunks(chunks, path, file_format,
+                                               columns)
+        else:
+            # Flattened and written one chunk of submissions at a time
+            tables = ka.iter_repeat_group_tables(user_uid, kobo=kobo)
+            first = next(tables, None)
+            submissions = rows = 0
+            if first is not None:
+                tables = itertools.chain([first], tables)
+                names = ka.VerificationNames(first.schema.choice_lists)
+                if file_format == 'xlsx':
+                    rows = write_fgd_workbook(tables, path, names)
+                else:
+                    rows = _write_chunks(
+                        rechunk(iter_project_fgd_chunks(tables, names)),
+                        path, file_format, FGD_EXPORT_COLUMNS)
+                submissions = len(names)
+        record.set(rows=rows, submissions=submissions)
+        if submissions:
+            record.set(bytes=os.path.getsize(path))
+        return submissions
+
+
+def _write_chunks(chunks, path, file_format, columns):
+    if file_format == 'csv':
+        return write_csv(chunks, path, columns)
+    if file_format == 'parquet':
+        return write_parquet(chunks, path, columns)
+    raise ValueError(f"Unknown export format: {file_format}")
+
+
+# Remove the export files older than EXPORT_TTL, or all the export files
+# of `user_uid` (e.g. when the project is reloaded from Kobo)
+def remove_stale_exports(user_uid=None):
+    cutoff = time.time() - EXPORT_TTL
+    try:
+        entries = list(os.scandir(EXPORT_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if not entry.is_file():
+                continue
+            if user_uid is not None:
+                # Exports being written are left to finish
+                stale = (entry.name.startswith(f"{user_uid}_") and
+                         not entry.name.endswith('.part'))
+            else:
+                stale = entry.stat().st_mtime < cutoff
+            if stale:
+                os.remove(entry.path)
+        except OSError:
+            pass
+    if user_uid is not None:
+        _exports.clear()
+
+
+# Path of the export of a project in `file_format`, written on first use
+# and reused (also by other sessions) until the project changes on Kobo.
+# Returns None when the project has no data.
+def get_export_file(user_uid, kind, file_format, query=None, fields=None):
+    key = (user_uid, kind, file_format, ka.get_freshness_token(user_uid),
+           query, fields)
+    path = _exports.get_or_compute(key, lambda: _export_file(key))
+    if path is not None and not os.path.exists(path):
+        # Removed from disk in the meantime
+        path = _export_file(key)
+        _exports.set(key, path)
+    return path
+
+
+def _export_file(key):
+    user_uid, kind, file_format, _, query, fields = key
+    digest = hashlib.sha1(json.dumps(key, default=str).encode('utf-8'))
+    extension = EXPORT_FORMATS[file_format][0]
+    path = os.path.join(EXPORT_DIR, f"{user_uid}_{kind}_"
+                                    f"{digest.hexdigest()[:16]}.{extension}")
+    if os.path.exists(path):
+        return path
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    remove_stale_exports()
+    # Written under a temporary name, so a failed export leaves no file
+    # that looks complete
+    partial = f"{path}.{os.getpid()}.part"
+    try:
+        submissions = write_project_export(user_uid, kind, partial,
+                                           file_format, query=query,
+                                           fields=fields)
+        if not submissions:
+            return None
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return path
+
+
+# Sidebar export of a whole project ('kii' or 'fgd'; KII loads filtered
+# with `query` and `fields` export the same selection). The file is only
+# written when the user asks for it; the session then keeps offering it
+# until the project changes.
+def export_controls(user_uid, kind, file_name, key, query=None,
+                    fields=None):
+    import streamlit as st
+
+    with st.sidebar.expander("Export all data"):
+        file_format = st.selectbox(
+            "Format", KII_FORMATS if kind == 'kii' else FGD_FORMATS,
+            format_func=lambda name: EXPORT_FORMATS[name][2],
+            key=f"{key}_export_format")
+        state_key = f"{key}_export"
+        wanted = (file_format, ka.get_freshness_token(user_uid), query,
+                  fields)
+        prepared = st.session_state.get(state_key)
+        path = prepared[1] if prepared and prepared[0] == wanted else None
+        if path is None or not os.path.exists(path):
+            if not st.button("Prepare export", key=f"{key}_export_prepare"):
+                return
+            with st.spinner("Writing the export..."):
+                path = get_export_file(user_uid, kind, file_format,
+                                       query=query, fields=fields)
+            if path is None:
+                st.write("No data to export")
+                return
+            st.session_state[state_key] = (wanted, path)
+
+        extension, mime, _ = EXPORT_FORMATS[file_format]
+        with open(path, 'rb') as f:
+            st.download_button(
+                label=f"Download {EXPORT_FORMATS[file_format][2]} file",
+                data=f,
+                file_name=f"{file_name}.{extension}",
+                mime=mime,
+                key=f"{key}_export_download")
@@ -0,0 +1,145 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from kobo_trace import span
+
+# Map of the submissions of a project. Points are binned here, on the
+# server, into square or hexagonal cells, and only the cells (outline,
+# count and color) are sent to the browser, so tens of thousands of
+# submissions draw as a few hundred polygons.
+
+# Number of cells the points are spread over at most (roughly: the cell
+# size is picked from the extent of the points), and the smallest cell
+MAP_BINS = 1500
+MIN_BIN_METERS = 50
+
+BIN_KINDS = {'hex': 'Hexagons', 'grid': 'Squares'}
+
+METERS_PER_DEGREE = 111320
+
+# Cell colors, from the emptiest to the fullest cell (log scale)
+LOW_COLOR = np.array([255, 237, 160])
+HIGH_COLOR = np.array([189, 0, 38])
+BIN_ALPHA = 170
+
+SQRT3 = math.sqrt(3)
+
+
+# Width of the cells for points at (x, y) meters: about `max_bins` cells
+# over the area holding 98% of them, rounded to 1, 2 or 5 x 10^n meters
+def bin_size(x, y, max_bins=None):
+    max_bins = max_bins or MAP_BINS
+    (x0, x1), (y0, y1) = (np.percentile(x, [1, 99]),
+                          np.percentile(y, [1, 99]))
+    size = max(math.sqrt((x1 - x0) * (y1 - y0) / max_bins),
+               (max(x1 - x0, y1 - y0)) / max_bins, MIN_BIN_METERS)
+    scale = 10 ** math.floor(math.log10(size))
+    for step in (1, 2, 5, 10):
+        if size <= step * scale:
+            return float(step * scale)
+
+
+# Bin points (a frame with Latitude and Longitude columns, NaN when
+# unknown) into `kind` cells ('hex' or 'grid') `size` meters wide (see
+# bin_size when None). Coordinates are projected to meters around the mean
+# latitude, which is exact enough at the scale of a country. Returns one
+# row per non-empty cell (center Latitude and Longitude, count, polygon as
+# [longitude, latitude] vertices and RGBA color) and the cell width.
+def bin_points(points, kind='hex', size=None, max_bins=None):
+    lat = points['Latitude'].to_numpy(dtype='float64')
+    lon = points['Longitude'].to_numpy(dtype='float64')
+    keep = (np.isfinite(lat) & np.isfinite(lon) &
+            (np.abs(lat) <= 90) & (np.abs(lon) <= 180))
+    lat, lon = lat[keep], lon[keep]
+    columns = ['Latitude', 'Longitude', 'count', 'polygon', 'color']
+    if not len(lat):
+        return pd.DataFrame(columns=columns), size
+
+    kx = METERS_PER_DEGREE * math.cos(math.radians(lat.mean()))
+    ky = METERS_PER_DEGREE
+    x, y = lon * kx, lat * ky
+    size = size or bin_size(x, y, max_bins)
+
+    if kind == 'grid':
+        cells = np.column_stack([np.floor(x / size), np.floor(y / size)])
+        cells, counts = np.unique(cells, axis=0, return_counts=True)
+        cx = (cells[:, 0] + 0.5) * size
+        cy = (cells[:, 1] + 0.5) * size
+        half = size / 2
+        dx = np.array([-half, half, half, -half])
+        dy = np.array([-half, -half, half, half])
+    else:
+        # Pointy-top hexagons of circumradius r in axial coordinates,
+        # rounded to the nearest hexagon through cube coordinates
+        r = size / SQRT3
+        q = (SQRT3 / 3 * x - y / 3) / r
+        s = (2 / 3 * y) / r
+        cube = np.column_stack([q, -q - s, s])
+        rounded = np.round(cube)
+        diff = np.abs(rounded - cube)
+        largest = diff.argmax(axis=1)
+        rows = np.arange(len(cube))
+        # The coordinate rounded furthest is recomputed from the others
+        rounded[rows, largest] = 0
+        rounded[rows, largest] = -rounded.sum(axis=1)
+        cells, counts = np.unique(rounded[:, [0, 2]], axis=0,
+                                  return_counts=True)
+        cx = r * SQRT3 * (cells[:, 0] + cells[:, 1] / 2)
+        cy = r * 1.5 * cells[:, 1]
+        angles = np.radians(np.arange(6) * 60 - 30)
+        dx = r * np.cos(angles)
+        dy = r * np.sin(angles)
+
+    polygons = np.stack([(cx[:, None] + dx) / kx,
+                         (cy[:, None] + dy) / ky], axis=-1)
+    level = np.log1p(counts) / np.log1p(counts.max())
+    colors = np.rint(LOW_COLOR + level[:, None] * (HIGH_COLOR - LOW_COLOR))
+    colors = np.column_stack([colors, np.full(len(counts), BIN_ALPHA)])
+    bins = pd.DataFrame({
+        'Latitude': cy / ky,
+        'Longitude': cx / kx,
+        'count': counts,
+        'polygon': polygons.tolist(),
+        'color': colors.astype(int).tolist(),
+    }, columns=columns)
+    return bins, size
+
+
+# Cell width for captions, e.g. '200 m' or '5 km'
+def format_distance(meters):
+    if meters >= 1000:
+        return f"{meters / 1000:g} km"
+    return f"{meters:g} m"
+
+
+# Map of `points` (see bin_points) binned into cells the user picks
+def location_map(points, key):
+    import pydeck as pdk
+    import streamlit as st
+
+    kind = st.radio("Cells", tuple(BIN_KINDS), format_func=BIN_KINDS.get,
+                    horizontal=True, key=f"{key}_map_cells")
+    with span('bin_points', rows=len(points), kind=kind) as record:
+        bins, size = bin_points(points, kind)
+        record.set(bins=len(bins))
+    if bins.empty:
+        st.info("No submission has a location.")
+        return
+
+    layer = pdk.Layer(
+        'PolygonLayer',
+        data=bins[['polygon', 'color', 'count']],
+        get_polygon='polygon',
+        get_fill_color='color',
+        get_line_color=[80, 80, 80, 120],
+        line_width_min_pixels=1,
+        pickable=True,
+        auto_highlight=True)
+    view = pdk.data_utils.compute_view(bins[['Longitude', 'Latitude']])
+    st.pydeck_chart(pdk.Deck(layers=[layer], initial_view_state=view,
+                             tooltip={'text': '{count} submissions'}))
+    st.caption(f"{int(bins['count'].sum())} of {len(points)} submissions "
+               f"with a location, in {len(bins)} cells of "
+               f"{format_distance(size)}")
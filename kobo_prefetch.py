@@ -0,0 +1,98 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import kobo_access as ka
+from kobo_trace import span, traced
+
+# Run the background prefetcher in the app process
+PREFETCH = os.environ.get('KOBO_PREFETCH', '1') == '1'
+
+# Seconds between two rounds. Kept below kobo_access.PROJECTS_CACHE_TTL so
+# the asset list is refreshed before it expires in front of a user.
+PREFETCH_INTERVAL = float(os.environ.get('KOBO_PREFETCH_INTERVAL', '240'))
+
+# Number of hot projects warmed per round, and how many at the same time
+PREFETCH_PROJECTS = int(os.environ.get('KOBO_PREFETCH_PROJECTS', '4'))
+PREFETCH_WORKERS = int(os.environ.get('KOBO_PREFETCH_WORKERS', '2'))
+
+logger = logging.getLogger('kobo_prefetch')
+
+
+# Background thread keeping the caches warm: every `interval` seconds it
+# downloads the asset list again, then loads the hot projects (see
+# kobo_access.hot_projects) through the cached loaders used by the app.
+# Projects that did not change since the last round are cache hits, so a
+# round only costs the asset list and the new submissions.
+class Prefetcher:
+    def __init__(self, interval=None, projects=None, workers=None):
+        self.interval = interval or PREFETCH_INTERVAL
+        self.projects = PREFETCH_PROJECTS if projects is None else projects
+        self.workers = max(1, workers or PREFETCH_WORKERS)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='kobo-prefetch', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Prefetch round failed")
+            self._stop.wait(self.interval)
+
+    # One round: refresh the asset list and warm the hot projects
+    def run_once(self):
+        with span('prefetch') as record:
+            ka.refresh_kobo_assets()
+            targets = ka.hot_projects(self.projects)
+            record.set(rows=len(targets))
+            if not targets:
+                return targets
+            with ThreadPoolExecutor(max_workers=self.workers,
+                                    thread_name_prefix='kobo-prefetch'
+                                    ) as executor:
+                for target in targets:
+                    executor.submit(traced(self.warm), target)
+        return targets
+
+    # Load one (kind, asset uid, verification) target into the caches
+    def warm(self, target):
+        kind, user_uid, ver_no = target
+        try:
+            with span('prefetch_project', asset=user_uid, kind=kind):
+                if kind == 'kii':
+                    ka.get_cached_kii_data(user_uid)
+                elif ver_no is None:
+                    ka.get_cached_verification_index(user_uid)
+                else:
+                    ka.get_cached_verification_frame(user_uid, ver_no)
+        except Exception:
+            logger.exception("Prefetch of %s %s failed", kind, user_uid)
+
+
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+
+# Start the prefetcher shared by all sessions of the process (once)
+def start_prefetcher():
+    global _prefetcher
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = Prefetcher()
+        _prefetcher.start()
+        return _prefetcher
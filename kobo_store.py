@@ -0,0 +1,333 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Directory holding the local copies of Kobo submissions, one file per asset
+STORE_DIR = os.environ.get('KOBO_STORE_DIR', '.kobo_store')
+
+# Submission field holding the instance id, which changes on every edit
+INSTANCE_ID_FIELD = 'meta/instanceID'
+
+
+# Local on-disk copy of the submissions of one Kobo asset. Submissions are
+# kept as raw JSON keyed by their Kobo `_id`, which only ever increases, so
+# the largest stored `_id` is the high-water mark for incremental syncs.
+# The instance id of each submission is kept beside it: Kobo gives an
+# edited submission a new one, so comparing them tells which stored
+# submissions were changed on Kobo.
+class SubmissionStore:
+    def __init__(self, asset_uid, store_dir=None):
+        store_dir = store_dir or STORE_DIR
+        os.makedirs(store_dir, exist_ok=True)
+        self.asset_uid = asset_uid
+        self.path = os.path.join(store_dir, f'{asset_uid}.sqlite')
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS submissions ('
+                'id INTEGER PRIMARY KEY, '
+                'submission_time TEXT, '
+                'payload TEXT NOT NULL, '
+                'instance_id TEXT)')
+            columns = [row[1] for row in conn.execute(
+                'PRAGMA table_info(submissions)')]
+            if 'instance_id' not in columns:
+                # Stores written before instance ids were kept
+                conn.execute(
+                    'ALTER TABLE submissions ADD COLUMN instance_id TEXT')
+                conn.execute(
+                    'UPDATE submissions SET '
+                    'instance_id = json_extract(payload, ?)',
+                    (f'$."{INSTANCE_ID_FIELD}"',))
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    # Largest `_id` and `_submission_time` stored so far (None when empty)
+    def high_water_mark(self):
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                'SELECT MAX(id), MAX(submission_time) FROM submissions'
+            ).fetchone()
+
+    def count(self):
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                'SELECT COUNT(*) FROM submissions').fetchone()[0]
+
+    # Instance id of every stored submission, by `_id`
+    def instance_ids(self):
+        with closing(self._connect()) as conn:
+            return dict(conn.execute(
+                'SELECT id, instance_id FROM submissions'))
+
+    # Insert new submissions, replacing any already stored with the same id
+    def merge(self, results):
+        rows = [(result['_id'], result.get('_submission_time'),
+                 json.dumps(result), result.get(INSTANCE_ID_FIELD))
+                for result in results]
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO submissions '
+                '(id, submission_time, payload, instance_id) '
+                'VALUES (?, ?, ?, ?)', rows)
+        return len(rows)
+
+    # Remove the submissions with the given ids, e.g. deleted on Kobo
+    def delete(self, submission_ids):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany('DELETE FROM submissions WHERE id = ?',
+                             [(i,) for i in submission_ids])
+
+    # Remove all stored submissions, e.g. before a full download
+    def clear(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('DELETE FROM submissions')
+
+    # A single stored submission (None if it is not in the store)
+    def get(self, submission_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                'SELECT payload FROM submissions WHERE id = ?',
+                (submission_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # Yield the stored submissions in pages of `page_size`, in `_id` order.
+    # Pages are read by keyset (id > last id seen) so each query is cheap
+    # and only one page is decoded at a time.
+    def iter_pages(self, page_size=1000):
+        last_id = None
+        with closing(self._connect()) as conn:
+            while True:
+                if last_id is None:
+                    rows = conn.execute(
+                        'SELECT id, payload FROM submissions '
+                        'ORDER BY id LIMIT ?', (page_size,)).fetchall()
+                else:
+                    rows = conn.execute(
+                        'SELECT id, payload FROM submissions WHERE id > ? '
+                        'ORDER BY id LIMIT ?',
+                        (last_id, page_size)).fetchall()
+                if not rows:
+                    return
+                last_id = rows[-1][0]
+                yield [json.loads(payload) for _, payload in rows]
+
+    # Yield the stored submissions in pages of `page_size` ordered by
+    # `_submission_time`, then `_id` (the order the app shows them in),
+    # from a single query read one page at a time
+    def iter_pages_by_time(self, page_size=1000):
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                'SELECT payload FROM submissions '
+                'ORDER BY submission_time, id')
+            while True:
+                rows = cursor.fetchmany(page_size)
+                if not rows:
+                    return
+                yield [json.loads(payload) for payload, in rows]
+
+
+# Labeled frames of one version of a Kobo asset, saved as uncompressed Arrow
+# IPC files (one per frame name) so they can be memory-mapped back: a
+# process restart or another app replica reads a frame without downloading
+# or labeling it again, and only the requested columns and rows are
+# converted to pandas (see StoredFrame). Arrow fields are named by position and the original
+# row and column labels kept in the schema metadata, so any labels
+# (duplicated, non-string) round-trip. Saving a version removes the files
+# of older versions of the asset.
+class FrameStore:
+    def __init__(self, asset_uid, version, store_dir=None):
+        self.asset_uid = asset_uid
+        self.asset_dir = os.path.join(store_dir or STORE_DIR, 'frames',
+                                      asset_uid)
+        digest = hashlib.sha1(json.dumps(version).encode('utf-8'))
+        self.path = os.path.join(self.asset_dir, digest.hexdigest()[:16])
+
+    def _file(self, name):
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.path, f'{digest}.arrow')
+
+    def __contains__(self, name):
+        return os.path.exists(self._file(name))
+
+    # Save a frame. Columns pyarrow cannot type (e.g. mixing text and
+    # numbers) raise pyarrow.ArrowException and nothing is written.
+    def save(self, name, df):
+        if isinstance(df.index, pd.RangeIndex):
+            index = None
+        else:
+            index = df.index.tolist()
+        table = pa.Table.from_pandas(
+            df.set_axis([str(i) for i in range(df.shape[1])], axis=1),
+            preserve_index=False)
+        metadata = {'columns': df.columns.tolist(), 'index': index}
+        table = table.replace_schema_metadata(
+            {'kobo_frame': json.dumps(metadata)})
+
+        os.makedirs(self.path, exist_ok=True)
+        path = self._file(name)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+
+        # Older versions of the asset are no longer needed
+        for entry in os.listdir(self.asset_dir):
+            if entry != os.path.basename(self.path):
+                shutil.rmtree(os.path.join(self.asset_dir, entry),
+                              ignore_errors=True)
+
+    # Remove the saved frames of every version of the asset, e.g. when its
+    # submissions are downloaded again
+    def clear(self):
+        shutil.rmtree(self.asset_dir, ignore_errors=True)
+
+    # Memory-mapped table and label metadata of a saved frame
+    def _open(self, name):
+        with pa.memory_map(self._file(name)) as source:
+            table = pa.ipc.open_file(source).read_all()
+        metadata = json.loads(table.schema.metadata[b'kobo_frame'])
+        return table, metadata
+
+    # Load a saved frame, or only the `columns` (positions) and `rows`
+    # (a slice) of it. Returns None if the frame was never saved.
+    def load(self, name, columns=None, rows=None):
+        if name not in self:
+            return None
+        table, metadata = self._open(name)
+        labels = metadata['columns']
+        index = metadata['index']
+        if columns is not None:
+            columns = [int(i) for i in columns]
+            table = table.select(columns)
+            labels = [labels[i] for i in columns]
+        if rows is not None:
+            start, stop, _ = rows.indices(table.num_rows)
+            table = table.slice(start, max(stop - start, 0))
+            if index is not None:
+                index = index[start:stop]
+        df = table.to_pandas()
+        # Arrow nulls come back as None in object columns, the frames were
+        # saved with NaN there
+        for i in np.flatnonzero(df.dtypes.to_numpy() == object):
+            column = df.iloc[:, i]
+            df.isetitem(i, column.where(column.notna(), np.nan))
+        df.columns = labels
+        if index is not None:
+            df.index = index
+        elif rows is not None:
+            df.index = pd.RangeIndex(start, start + len(df))
+        return df
+
+    # A saved frame to read in parts, None if it was never saved
+    def open(self, name):
+        if name not in self:
+            return None
+        return StoredFrame(self, name)
+
+
+# A frame saved in a FrameStore, read lazily: its column labels and shape
+# come from the file schema and footer, and read() converts only the
+# requested columns and rows to pandas
+class StoredFrame:
+    def __init__(self, store, name):
+        table, metadata = store._open(name)
+        self.store = store
+        self.name = name
+        self.columns = pd.Index(metadata['columns'])
+        self.shape = (table.num_rows, table.num_columns)
+
+    def __len__(self):
+        return self.shape[0]
+
+    # The `columns` (positions) and `rows` (a slice) of the frame, the
+    # whole frame by default
+    def read(self, columns=None, rows=None):
+        return self.store.load(self.name, columns=columns, rows=rows)
+
+
+# Reviewers' edits of one frame (a KII project, or one verification of an
+# FGD project), kept next to the submission stores. Each commit is stored as
+# the data editor delta it was made with, i.e. the cell patches by row
+# position and column name plus the added and deleted rows, so the log
+# stays small whatever the size of the frame it applies to. A commit also
+# records the freshness token of the data it was made on and the question
+# label of each row it touches, so it can be checked against newer data.
+class EditLog:
+    _lock = threading.Lock()
+
+    def __init__(self, asset_uid, frame_name='', store_dir=None):
+        store_dir = os.path.join(store_dir or STORE_DIR, 'edits')
+        os.makedirs(store_dir, exist_ok=True)
+        digest = hashlib.sha1(frame_name.encode('utf-8')).hexdigest()[:12]
+        self.asset_uid = asset_uid
+        self.frame_name = frame_name
+        self.path = os.path.join(store_dir, f'{asset_uid}-{digest}.json')
+
+    # Committed deltas, oldest first
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)['commits']
+        except FileNotFoundError:
+            return []
+
+    # Append one commit, ignoring deltas without any change. `questions`
+    # gives the question label of the rows of the frame the delta was made
+    # on (by position) and `token` the freshness token of its data. The file
+    # is re-read under the lock and replaced atomically, so concurrent
+    # sessions reviewing the same frame do not lose each other's commits.
+    def append(self, delta, questions=None, token=None):
+        delta = {
+            'edited_rows': {str(row): dict(cells) for row, cells
+                            in delta.get('edited_rows', {}).items() if cells},
+            'added_rows': [dict(row) for row in delta.get('added_rows', [])],
+            'deleted_rows': sorted(int(row) for row
+                                   in delta.get('deleted_rows', [])),
+        }
+        if not any(delta.values()):
+            return False
+        if questions is not None:
+            rows = list(delta['edited_rows']) + delta['deleted_rows']
+            delta['questions'] = {
+                str(row): _question_label(questions, int(row))
+                for row in rows}
+        delta['token'] = token
+        with self._lock:
+            commits = self.load()
+            commits.append(delta)
+            self._save(commits)
+        return True
+
+    # Drop all commits, going back to the frame as fetched from Kobo
+    def clear(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _save(self, commits):
+        content = {'asset_uid': self.asset_uid,
+                   'frame_name': self.frame_name,
+                   'commits': commits}
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(content, f)
+        os.replace(tmp_path, self.path)
+
+
+# Label of row `row` of `questions` as stored in an edit log: text only,
+# None for rows beyond the end or without a text label
+def _question_label(questions, row):
+    if not 0 <= row < len(questions):
+        return None
+    label = questions[row]
+    return label if isinstance(label, str) else None
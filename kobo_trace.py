@@ -0,0 +1,109 @@
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Where spans are logged as JSON lines: '-' for stderr or a file path.
+# Unset, spans are only kept in memory for the diagnostics panel.
+TRACE_LOG = os.environ.get('KOBO_TRACE_LOG')
+
+logger = logging.getLogger('kobo_trace')
+
+_trace = contextvars.ContextVar('kobo_trace', default=None)
+_parent = contextvars.ContextVar('kobo_trace_parent', default=None)
+_ids = iter(range(1, sys.maxsize))
+_ids_lock = threading.Lock()
+
+
+def _next_id():
+    with _ids_lock:
+        return next(_ids)
+
+
+# One timed stage. Fields (rows, cols, bytes, cache, ...) can be added while
+# the stage runs with set().
+class Span:
+    def __init__(self, name, fields):
+        self.id = _next_id()
+        self.name = name
+        self.fields = fields
+        self.parent = None
+        self.started = None
+        self.seconds = None
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def to_dict(self):
+        return {'span': self.name, 'id': self.id, 'parent': self.parent,
+                'started': self.started, 'seconds': self.seconds,
+                **self.fields}
+
+
+# Time a stage of the pipeline. The finished span is added to the current
+# trace (see start_trace) and logged as JSON.
+@contextmanager
+def span(name, **fields):
+    record = Span(name, fields)
+    parent = _parent.get()
+    record.parent = parent.id if parent is not None else None
+    record.started = datetime.now(timezone.utc).isoformat(
+        timespec='milliseconds')
+    token = _parent.set(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record.set(error=type(e).__name__)
+        raise
+    finally:
+        record.seconds = round(time.perf_counter() - start, 6)
+        _parent.reset(token)
+        _finish(record)
+
+
+def _finish(record):
+    trace = _trace.get()
+    if trace is not None:
+        trace.append(record)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(record.to_dict(), default=str))
+
+
+# Start collecting the spans of the current context (e.g. one run of the
+# Streamlit script) and return the list they are appended to
+def start_trace():
+    trace = []
+    _trace.set(trace)
+    return trace
+
+
+# Run `func` with the current trace and parent span, e.g. in a worker
+# thread: executor.submit(traced(func), ...)
+def traced(func):
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.run(func, *args, **kwargs)
+    return run
+
+
+# Send spans to stderr ('-') or a file as one JSON object per line
+def configure_trace_log(target):
+    if target == '-':
+        handler = logging.StreamHandler(sys.stderr)
+    else:
+        handler = logging.FileHandler(target)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+if TRACE_LOG:
+    configure_trace_log(TRACE_LOG)